@@ -0,0 +1,322 @@
+"""Just enough of the FLAC, Ogg Vorbis and RIFF WAVE formats to read the
+stream parameters and tags out of a file's headers, so that we don't have to
+spawn metaflac, file or ogginfo for every track.
+
+Header fields come back the way the command-line tools printed them: a dict
+of bytes values with 'channels', 'frequency' and 'bitwidth' keys, plus
+lowercased tag names for the tags that we carry over when transcoding."""
+
+import hashlib
+import os
+import struct
+
+TAGS = [b'genre', b'artist', b'album', b'title', b'tracknumber']
+
+# How many bytes a second of CD audio takes, uncompressed.
+CD_BYTES_PER_SEC = 44100 * 2 * 2
+
+FLAC_STREAMINFO = 0
+FLAC_VORBIS_COMMENT = 4
+
+
+def format_duration(seconds):
+    (minutes, seconds) = divmod(int(seconds), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise Exception('Truncated header in %s' % f.name)
+    return data
+
+
+def _skip_id3v2(f):
+    """Some taggers stick an ID3v2 tag in front of a FLAC file."""
+    head = f.read(10)
+    if head[:3] == b'ID3' and len(head) == 10:
+        size = 0
+        for b in head[6:10]:
+            size = (size << 7) | (b & 0x7f)
+        f.seek(10 + size)
+    else:
+        f.seek(0)
+
+
+def parse_vorbis_comment(data):
+    """Returns the vendor string and a list of (lowercased key, value)
+    pairs."""
+    (vendor_len,) = struct.unpack_from('<I', data, 0)
+    pos = 4 + vendor_len
+    vendor = data[4:pos]
+    (count,) = struct.unpack_from('<I', data, pos)
+    pos += 4
+    comments = []
+    for _ in range(count):
+        (length,) = struct.unpack_from('<I', data, pos)
+        pos += 4
+        comment = data[pos:pos + length]
+        pos += length
+        if len(comment) != length:
+            raise Exception('Truncated Vorbis comment')
+        (key, sep, val) = comment.partition(b'=')
+        if sep:
+            comments.append((key.lower(), val))
+    return vendor, comments
+
+
+def _add_tags(header_fields, comments):
+    for (key, val) in comments:
+        if key in TAGS:
+            header_fields[key.decode('ascii')] = val
+
+
+def read_flac(path):
+    """Returns the STREAMINFO fields of a FLAC file as a dict, and its
+    Vorbis comments as a list of (key, value) pairs.  Only the metadata
+    blocks that we want are read; pictures and the like are skipped."""
+    streaminfo = None
+    comments = []
+    with open(path, 'rb') as f:
+        _skip_id3v2(f)
+        if f.read(4) != b'fLaC':
+            raise Exception('%s is not a FLAC file' % path)
+        last = False
+        while not last:
+            (block_header,) = struct.unpack('>I', _read_exactly(f, 4))
+            last = bool(block_header & 0x80000000)
+            block_type = (block_header >> 24) & 0x7f
+            length = block_header & 0xffffff
+            if block_type == FLAC_STREAMINFO:
+                streaminfo = _parse_streaminfo(_read_exactly(f, length))
+            elif block_type == FLAC_VORBIS_COMMENT:
+                (_, comments) = parse_vorbis_comment(_read_exactly(f, length))
+            else:
+                f.seek(length, 1)
+    if streaminfo is None:
+        raise Exception('%s has no STREAMINFO' % path)
+    return streaminfo, comments
+
+
+def _parse_streaminfo(data):
+    # Sample rate (20 bits), channels - 1 (3 bits), bits per sample - 1 (5
+    # bits) and total samples (36 bits) are packed together after the block
+    # and frame sizes.
+    (packed,) = struct.unpack_from('>Q', data, 10)
+    return {
+        'sample_rate': packed >> 44,
+        'channels': ((packed >> 41) & 0x7) + 1,
+        'bits_per_sample': ((packed >> 36) & 0x1f) + 1,
+        'total_samples': packed & 0xfffffffff,
+        'md5': data[18:34],
+    }
+
+
+def flac_header(path):
+    (streaminfo, comments) = read_flac(path)
+    header_fields = {
+        'channels': b'%d' % streaminfo['channels'],
+        'frequency': b'%d' % streaminfo['sample_rate'],
+        'bitwidth': b'%d' % streaminfo['bits_per_sample'],
+    }
+    _add_tags(header_fields, comments)
+    return header_fields
+
+
+def _ogg_pages(f):
+    """Yields (granule position, segment table, payload) for each page."""
+    while True:
+        header = f.read(27)
+        if not header:
+            return
+        if len(header) != 27 or header[:4] != b'OggS':
+            raise Exception('Bad Ogg page in %s' % f.name)
+        (granule,) = struct.unpack_from('<q', header, 6)
+        segments = _read_exactly(f, header[26])
+        payload = _read_exactly(f, sum(segments))
+        yield granule, segments, payload
+
+
+def _ogg_packets(f):
+    """Yields complete packets, reassembled across page boundaries."""
+    packet = b''
+    for (_, segments, payload) in _ogg_pages(f):
+        pos = 0
+        for lacing in segments:
+            packet += payload[pos:pos + lacing]
+            pos += lacing
+            if lacing < 255:
+                yield packet
+                packet = b''
+
+
+def read_ogg_vorbis(path):
+    """Returns the identification header fields of an Ogg Vorbis file as a
+    dict, and its comments as a list of (key, value) pairs.  Only the pages
+    that hold the first two header packets are read."""
+    with open(path, 'rb') as f:
+        packets = _ogg_packets(f)
+        ident = next(packets, b'')
+        if ident[:7] != b'\x01vorbis':
+            raise Exception('%s is not an Ogg Vorbis file' % path)
+        (channels, sample_rate) = struct.unpack_from('<BI', ident, 11)
+        comment = next(packets, b'')
+        if comment[:7] != b'\x03vorbis':
+            raise Exception('%s has no Vorbis comment header' % path)
+        (_, comments) = parse_vorbis_comment(comment[7:])
+    return {'channels': channels, 'sample_rate': sample_rate}, comments
+
+
+def ogg_header(path):
+    (ident, comments) = read_ogg_vorbis(path)
+    header_fields = {
+        'channels': b'%d' % ident['channels'],
+        'frequency': b'%d' % ident['sample_rate'],
+        # Vorbis has no bit depth of its own; we always decode to 16 bits.
+        'bitwidth': b'16',
+    }
+    _add_tags(header_fields, comments)
+    return header_fields
+
+
+def read_wav(path):
+    """Returns the fmt chunk fields of a RIFF WAVE file as a dict, along with
+    the size of its data chunk."""
+    fmt = None
+    data_size = None
+    with open(path, 'rb') as f:
+        riff = _read_exactly(f, 12)
+        if riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise Exception('%s is not a WAVE file' % path)
+        while fmt is None or data_size is None:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                break
+            (chunk_id, size) = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                (audio_format, channels, sample_rate, byte_rate, block_align,
+                 bits_per_sample) = struct.unpack(
+                        '<HHIIHH', _read_exactly(f, 16))
+                fmt = {
+                    'channels': channels,
+                    'sample_rate': sample_rate,
+                    'byte_rate': byte_rate,
+                    'bits_per_sample': bits_per_sample,
+                }
+                # Chunks are padded to an even length.
+                f.seek(size - 16 + (size & 1), 1)
+            else:
+                if chunk_id == b'data':
+                    data_size = size
+                f.seek(size + (size & 1), 1)
+    if fmt is None:
+        raise Exception('%s has no fmt chunk' % path)
+    fmt['data_size'] = data_size
+    return fmt
+
+
+# The last Ogg page, which carries the final granule position, is at most this
+# far from the end of the file.
+OGG_TAIL_SIZE = 65536 + 282
+
+
+def _ogg_last_granule(path):
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - OGG_TAIL_SIZE))
+        tail = f.read()
+    pos = tail.rfind(b'OggS')
+    while pos >= 0:
+        if len(tail) - pos >= 14:
+            (granule,) = struct.unpack_from('<q', tail, pos + 6)
+            if granule >= 0:
+                return granule
+        pos = tail.rfind(b'OggS', 0, pos)
+    raise Exception('No final Ogg page in %s' % path)
+
+
+def duration(path):
+    """Returns the length of the audio in a FLAC, Ogg Vorbis or WAVE file in
+    seconds, reading only its headers (and, for Ogg, its last page)."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.flac':
+        (streaminfo, _) = read_flac(path)
+        return streaminfo['total_samples'] / streaminfo['sample_rate']
+    elif ext == '.ogg':
+        (ident, _) = read_ogg_vorbis(path)
+        return _ogg_last_granule(path) / ident['sample_rate']
+    elif ext == '.wav':
+        fmt = read_wav(path)
+        return (fmt['data_size'] or 0) / fmt['byte_rate']
+    else:
+        raise Exception("Don't know how long %s is" % path)
+
+
+def _wav_data(f):
+    """Seeks to the start of a WAVE file's data chunk and returns its size."""
+    riff = _read_exactly(f, 12)
+    if riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise Exception('%s is not a WAVE file' % f.name)
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise Exception('%s has no data chunk' % f.name)
+        (chunk_id, size) = struct.unpack('<4sI', chunk_header)
+        if chunk_id == b'data':
+            return size
+        f.seek(size + (size & 1), 1)
+
+
+def audio_fingerprint(path):
+    """Returns a string that's the same for any two files with the same
+    audio, whatever their tags.  FLAC stores an MD5 of its samples in
+    STREAMINFO, and a WAVE file's data chunk holds the same bytes, so a FLAC
+    and the WAVE it came from match.  For Ogg Vorbis we hash the setup header
+    and audio packets, so only copies of the same encode match.  Returns None
+    for a FLAC file that was written without an MD5."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.flac':
+        (streaminfo, _) = read_flac(path)
+        if not any(streaminfo['md5']):
+            return None
+        return 'pcm:%d:%d:%d:%s' % (streaminfo['sample_rate'],
+                                    streaminfo['channels'],
+                                    streaminfo['bits_per_sample'],
+                                    streaminfo['md5'].hex())
+    elif ext == '.wav':
+        fmt = read_wav(path)
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            remaining = _wav_data(f)
+            while remaining:
+                data = f.read(min(remaining, 1 << 20))
+                if not data:
+                    raise Exception('Truncated data chunk in %s' % path)
+                md5.update(data)
+                remaining -= len(data)
+        return 'pcm:%d:%d:%d:%s' % (fmt['sample_rate'], fmt['channels'],
+                                    fmt['bits_per_sample'], md5.hexdigest())
+    elif ext == '.ogg':
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            # Skip the identification and comment headers.
+            for (i, packet) in enumerate(_ogg_packets(f)):
+                if i >= 2:
+                    sha1.update(struct.pack('<I', len(packet)))
+                    sha1.update(packet)
+        return 'vorbis:%s' % sha1.hexdigest()
+    else:
+        return None
+
+
+def comments(path):
+    """Returns the Vorbis comments of a FLAC or Ogg Vorbis file as a list of
+    (lowercased key, value) pairs, or [] for anything else."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.flac':
+        return read_flac(path)[1]
+    elif ext == '.ogg':
+        return read_ogg_vorbis(path)[1]
+    else:
+        return []
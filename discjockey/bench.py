@@ -0,0 +1,482 @@
+"""Benchmarks for the parts of Disc Jockey that don't depend on how fast the
+encoders are.  Everything runs against synthetic libraries in a scratch
+directory, with stub encoders, so no real audio is needed."""
+
+import argparse
+import builtins
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from discjockey import tagging, transcode
+
+SIGIL = '.sync'
+
+
+def make_deep_tree(root, depth, fanout, sigil_every):
+    """Build a tree of directories `depth` levels deep with `fanout`
+    subdirectories each, every one holding a single mp3.  Every
+    `sigil_every`th leaf gets a sigil.  Returns the number of directories."""
+    num_dirs = 0
+    num_leaves = 0
+    stack = [(root, 0)]
+    while stack:
+        path, level = stack.pop()
+        os.makedirs(path)
+        num_dirs += 1
+        with open(os.path.join(path, 'track.mp3'), 'wb'):
+            pass
+        if level == depth:
+            if num_leaves % sigil_every == 0:
+                with open(os.path.join(path, SIGIL), 'wb'):
+                    pass
+            num_leaves += 1
+        else:
+            for i in range(fanout):
+                stack.append((os.path.join(path, 'd%d' % i), level + 1))
+    return num_dirs
+
+
+def time_transcode(argv):
+    start = time.perf_counter()
+    transcode.transcode(argv)
+    return time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def scratch_dir(keep=False):
+    path = tempfile.mkdtemp(prefix='dj-bench-')
+    try:
+        yield path
+    finally:
+        if not keep:
+            shutil.rmtree(path)
+
+
+def bench_sigil(args):
+    with scratch_dir(args.keep) as scratch:
+        music = os.path.join(scratch, 'music')
+        num_dirs = make_deep_tree(music, args.depth, args.fanout,
+                                  args.sigil_every)
+        print('Synthetic tree: %d directories, depth %d, fanout %d'
+              % (num_dirs, args.depth, args.fanout))
+
+        # The same sync both times, each into a cache of its own: once
+        # walking each subtree to look for a sigil, as pruning did before
+        # the sigil index, and once with the index.
+        base_argv = ['--music', music, '--mirror', '--nomanifest',
+                     '--sigil', SIGIL]
+        walks = time_transcode(
+                base_argv + ['--cache', os.path.join(scratch, 'walks'),
+                             '--nosigil_index'])
+        index = time_transcode(
+                base_argv + ['--cache', os.path.join(scratch, 'index')])
+
+        print('Sigil sync, walking subtrees: %8.3fs' % walks)
+        print('Sigil sync, with the index:   %8.3fs' % index)
+        print('Speedup:                      %8.1fx' % (walks / index))
+
+
+def make_flat_library(root, num_dirs, files_per_dir):
+    """Build `num_dirs` album directories of `files_per_dir` empty mp3s
+    each.  Returns the number of files."""
+    for d in range(num_dirs):
+        album = os.path.join(root, 'artist%d' % (d // 10), 'album%d' % d)
+        os.makedirs(album)
+        for t in range(files_per_dir):
+            with open(os.path.join(album, '%02d.mp3' % t), 'wb'):
+                pass
+    return num_dirs * files_per_dir
+
+
+class _CountedDirEntry:
+    """Wraps a DirEntry so that we can see when it goes to the filesystem
+    for a stat.  DirEntry caches, so only the first call of each kind
+    counts."""
+
+    def __init__(self, entry, counts):
+        self._entry = entry
+        self._counts = counts
+        self._statted = set()
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def __fspath__(self):
+        return self._entry.path
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks not in self._statted:
+            self._statted.add(follow_symlinks)
+            self._counts['stat' if follow_symlinks else 'lstat'] += 1
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+
+class _CountedScandir:
+    def __init__(self, it, counts):
+        self._it = it
+        self._counts = counts
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return _CountedDirEntry(next(self._it), self._counts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._it.close()
+
+
+@contextlib.contextmanager
+def count_syscalls():
+    """Count the filesystem calls made through the os module while the
+    context is active.  Calls made from C (the encoders, sqlite) and the ones
+    that os.walk and friends make internally aren't seen."""
+    counts = collections.Counter()
+    patched = {}
+
+    def counted(module, name, kind):
+        real = getattr(module, name)
+        patched[(module, name)] = real
+
+        def wrapper(*args, **kwargs):
+            counts[kind] += 1
+            return real(*args, **kwargs)
+        setattr(module, name, wrapper)
+
+    for name in ['stat', 'lstat', 'listdir', 'link', 'unlink', 'mkdir',
+                 'rmdir', 'replace', 'rename', 'fsync']:
+        counted(os, name, name)
+    counted(builtins, 'open', 'open')
+    counted(subprocess, 'Popen', 'spawn')
+
+    real_scandir = os.scandir
+    patched[(os, 'scandir')] = real_scandir
+
+    def scandir(*args, **kwargs):
+        counts['scandir'] += 1
+        return _CountedScandir(real_scandir(*args, **kwargs), counts)
+    os.scandir = scandir
+
+    try:
+        yield counts
+    finally:
+        for ((module, name), real) in patched.items():
+            setattr(module, name, real)
+
+
+def print_counts(label, counts, num_files):
+    total = sum(counts.values())
+    print('%s: %d calls, %.2f per file' % (label, total, total / num_files))
+    for (kind, n) in sorted(counts.items()):
+        print('    %-8s %8d' % (kind, n))
+
+
+def bench_syscalls(args):
+    with scratch_dir(args.keep) as scratch:
+        music = os.path.join(scratch, 'music')
+        cache = os.path.join(scratch, 'cache')
+        num_files = make_flat_library(music, args.dirs, args.files_per_dir)
+        print('Synthetic library: %d files in %d albums'
+              % (num_files, args.dirs))
+
+        argv = ['--music', music, '--cache', cache, '--mirror']
+        if not args.manifest:
+            argv.append('--nomanifest')
+        with count_syscalls() as cold:
+            cold_time = time_transcode(argv)
+        with count_syscalls() as noop:
+            noop_time = time_transcode(argv)
+
+        print_counts('Cold run (%.3fs)' % cold_time, cold, num_files)
+        print_counts('No-op run (%.3fs)' % noop_time, noop, num_files)
+
+
+# Stands in for every encoder: writes an empty file wherever it was asked to
+# write, which is after -o if there is one and otherwise the last argument.
+STUB_ENCODER = '''#!/bin/sh
+out=
+prev=
+for arg in "$@"; do
+    if [ "$prev" = -o ]; then
+        out=$arg
+    fi
+    prev=$arg
+done
+: > "${out:-$prev}"
+'''
+
+# Stands in for the decoders and the tools that only read: says nothing.
+STUB_READER = '''#!/bin/sh
+exit 0
+'''
+
+GENRES = ['Rock', 'Jazz', 'Classical', 'Electronic', 'Folk', 'Hip-Hop',
+          'Country', 'Soundtrack']
+
+
+def write_stubs(stub_dir):
+    """Write the stub tools, and return the transcode flags that use
+    them."""
+    os.makedirs(stub_dir)
+    flags = []
+    for (name, script) in [('encoder', STUB_ENCODER),
+                           ('reader', STUB_READER)]:
+        path = os.path.join(stub_dir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    for tool in ['ogg', 'lame']:
+        flags += ['--%s_bin' % tool, os.path.join(stub_dir, 'encoder')]
+    for tool in ['oggdec', 'ogginfo', 'flac', 'file', 'metaflac']:
+        flags += ['--%s_bin' % tool, os.path.join(stub_dir, 'reader')]
+    return flags
+
+
+def fake_flac(artist, album, title, tracknumber, seconds):
+    """A FLAC file with real STREAMINFO and VORBIS_COMMENT blocks and no
+    audio, which is all that transcode ever reads itself."""
+    sample_rate = 44100
+    packed = ((sample_rate << 44) | (1 << 41) | (15 << 36)
+              | (sample_rate * seconds))
+    streaminfo = struct.pack('>HH3s3sQ16s', 4096, 4096, b'\0\0\0',
+                             b'\0\0\0', packed, bytes(16))
+    vendor = b'discjockey bench'
+    comments = [b'ARTIST=' + artist, b'ALBUM=' + album, b'TITLE=' + title,
+                b'TRACKNUMBER=%d' % tracknumber, b'GENRE=Synthetic']
+    vorbis_comment = struct.pack('<I', len(vendor)) + vendor
+    vorbis_comment += struct.pack('<I', len(comments))
+    for comment in comments:
+        vorbis_comment += struct.pack('<I', len(comment)) + comment
+    return (b'fLaC' + struct.pack('>I', len(streaminfo)) + streaminfo
+            + struct.pack('>I', 0x84000000 | len(vorbis_comment))
+            + vorbis_comment)
+
+
+def make_library(root, num_files, sigil, seed=0):
+    """Build a library of about `num_files` tracks laid out as
+    Genre/Artist/Album, mostly FLAC with some albums of mp3s.  Most artists
+    are synced with a sigil, some albums come with their own playlist, and a
+    few of those playlists reach into other albums, some of them unsynced.
+    Returns the number of music files."""
+    rng = random.Random(seed)
+    made = 0
+    albums = []
+    artist_num = 0
+    while made < num_files:
+        genre = rng.choice(GENRES)
+        artist = 'Artist %d' % artist_num
+        artist_num += 1
+        artist_dir = os.path.join(root, genre, artist)
+        os.makedirs(artist_dir)
+        if rng.random() < 0.8:
+            with open(os.path.join(artist_dir, sigil), 'wb'):
+                pass
+        for album_num in range(rng.randint(1, 5)):
+            album = 'Album %d' % album_num
+            album_dir = os.path.join(artist_dir, album)
+            os.makedirs(album_dir)
+            ext = '.mp3' if rng.random() < 0.2 else '.flac'
+            tracks = []
+            for track in range(1, rng.randint(6, 16) + 1):
+                filename = '%02d Track %d%s' % (track, track, ext)
+                with open(os.path.join(album_dir, filename), 'wb') as f:
+                    if ext == '.flac':
+                        f.write(fake_flac(
+                                artist.encode(), album.encode(),
+                                b'Track %d' % track, track,
+                                rng.randint(120, 480)))
+                tracks.append(filename)
+            made += len(tracks)
+            with open(os.path.join(album_dir, 'cover.jpg'), 'wb'):
+                pass
+            if rng.random() < 0.3:
+                lines = list(tracks)
+                if albums and rng.random() < 0.3:
+                    # Borrow a track from some earlier album.
+                    (other_dir, other_tracks) = rng.choice(albums)
+                    lines.append(os.path.relpath(
+                            os.path.join(other_dir, other_tracks[0]),
+                            album_dir))
+                with open(os.path.join(album_dir, 'favorites.m3u'),
+                          'w') as f:
+                    f.write(''.join('%s\n' % line for line in lines))
+            albums.append((album_dir, tracks))
+    return made
+
+
+def measured_run():
+    """Run one transcode with the argv given as JSON on our command line,
+    and print its wall time and syscall counts as JSON.  Runs in a process of
+    its own, so that the parent can measure its peak RSS."""
+    argv = json.loads(sys.argv[1])
+    with contextlib.redirect_stdout(io.StringIO()):
+        with count_syscalls() as counts:
+            wall = time_transcode(argv)
+    print(json.dumps({'wall': wall, 'counts': counts}))
+
+
+def measure(argv):
+    """Returns the wall time, syscall counts and peak RSS in KiB of a
+    transcode run."""
+    proc = subprocess.Popen(
+            [sys.executable, '-c',
+             'from discjockey import bench; bench.measured_run()',
+             json.dumps(argv)],
+            stdout=subprocess.PIPE)
+    out = proc.stdout.read()
+    proc.stdout.close()
+    (_, status, rusage) = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise Exception('Benchmark run failed')
+    result = json.loads(out)
+    return result['wall'], result['counts'], rusage.ru_maxrss
+
+
+def bench_library(args):
+    print('%-8s %-6s %9s %10s %8s %9s %10s'
+          % ('files', 'run', 'wall', 'fs calls', 'spawns', 'per file',
+             'peak RSS'))
+    for num_files in args.files:
+        with scratch_dir(args.keep) as scratch:
+            music = os.path.join(scratch, 'music')
+            made = make_library(music, num_files, SIGIL)
+            argv = ['--music', music,
+                    '--cache', os.path.join(scratch, 'cache'),
+                    '--sigil', SIGIL] + write_stubs(
+                            os.path.join(scratch, 'stubs'))
+            if args.mp3:
+                argv.append('--mp3')
+            if args.jobs:
+                argv += ['--jobs', str(args.jobs)]
+            for run in ['cold', 'no-op']:
+                (wall, counts, rss) = measure(argv)
+                spawns = counts.pop('spawn', 0)
+                calls = sum(counts.values())
+                print('%-8d %-6s %8.2fs %10d %8d %9.2f %7d MiB'
+                      % (made, run, wall, calls, spawns, calls / made,
+                         rss // 1024))
+
+
+def make_album(root, num_tracks, audio_bytes, padded_fraction, seed=0):
+    """Write an album of FLAC files with `audio_bytes` of junk standing in
+    for the audio, the given fraction of them with padding after their
+    comments.  Returns their paths."""
+    rng = random.Random(seed)
+    os.makedirs(root)
+    paths = []
+    for track in range(1, num_tracks + 1):
+        data = bytearray(fake_flac(b'Artist', b'Album', b'Track %d' % track,
+                                   track, 240))
+        if rng.random() < padded_fraction:
+            # The comment header is right after STREAMINFO's.
+            data[42] &= ~tagging.FLAC_LAST_BLOCK
+            data += b'\x81' + (8192).to_bytes(3, 'big') + bytes(8192)
+        path = os.path.join(root, '%03d Track %d.flac' % (track, track))
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.write(rng.randbytes(audio_bytes))
+        paths.append(path)
+    return paths
+
+
+def bench_tagging(args):
+    """Retag an album the way `dj rename` used to, with a metaflac per
+    track, and the way it does now."""
+    def tags(track):
+        return [(b'genre', b'Rock'), (b'artist', b'Renamed Artist'),
+                (b'album', b'Renamed Album'),
+                (b'title', b'Track %d, renamed' % track),
+                (b'tracknumber', b'%d' % track)]
+
+    with scratch_dir(args.keep) as scratch:
+        print('Album: %d tracks of %d KiB, %d%% padded'
+              % (args.tracks, args.audio_kb, args.padded_fraction * 100))
+        if os.path.exists(args.metaflac_bin):
+            paths = make_album(os.path.join(scratch, 'metaflac'),
+                               args.tracks, args.audio_kb * 1024,
+                               args.padded_fraction)
+            start = time.perf_counter()
+            for (track, path) in enumerate(paths, 1):
+                subprocess.check_output(
+                        [args.metaflac_bin, '--remove-all-tags']
+                        + ['--set-tag=%s=%s' % (key.upper().decode(),
+                                                val.decode())
+                           for (key, val) in tags(track)]
+                        + [path])
+            print('metaflac per track:   %8.3fs'
+                  % (time.perf_counter() - start))
+        else:
+            print('No %s, so no metaflac to compare with'
+                  % args.metaflac_bin)
+
+        paths = make_album(os.path.join(scratch, 'native'), args.tracks,
+                           args.audio_kb * 1024, args.padded_fraction)
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+            in_place = sum(pool.map(
+                    lambda job: tagging.retag_flac(job[1], tags(job[0])),
+                    enumerate(paths, 1)))
+        print('Native, thread pool:  %8.3fs (%d in place, %d rewritten)'
+              % (time.perf_counter() - start, in_place,
+                 len(paths) - in_place))
+
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the scratch directory')
+    subparsers = parser.add_subparsers(dest='suite', required=True)
+
+    sigil_parser = subparsers.add_parser('sigil')
+    sigil_parser.add_argument('--depth', type=int, default=12)
+    sigil_parser.add_argument('--fanout', type=int, default=2)
+    sigil_parser.add_argument('--sigil_every', type=int, default=64)
+    sigil_parser.set_defaults(func=bench_sigil)
+
+    syscalls_parser = subparsers.add_parser('syscalls')
+    syscalls_parser.add_argument('--dirs', type=int, default=200)
+    syscalls_parser.add_argument('--files_per_dir', type=int, default=12)
+    syscalls_parser.add_argument('--nomanifest', action='store_false',
+                                 dest='manifest')
+    syscalls_parser.set_defaults(func=bench_syscalls)
+
+    library_parser = subparsers.add_parser('library')
+    library_parser.add_argument('--files', type=int, action='append',
+                                help='library sizes to try (default 1000 '
+                                'and 10000)')
+    library_parser.add_argument('--mp3', action='store_true')
+    library_parser.add_argument('-j', '--jobs', type=int)
+    library_parser.set_defaults(func=bench_library)
+
+    tagging_parser = subparsers.add_parser('tagging')
+    tagging_parser.add_argument('--tracks', type=int, default=300)
+    tagging_parser.add_argument('--audio_kb', type=int, default=1024)
+    tagging_parser.add_argument('--padded_fraction', type=float,
+                                default=0.5)
+    tagging_parser.add_argument('--metaflac_bin', default='/usr/bin/metaflac')
+    tagging_parser.add_argument('-j', '--jobs', type=int)
+    tagging_parser.set_defaults(func=bench_tagging)
+
+    args = parser.parse_args()
+    if args.suite == 'library' and not args.files:
+        args.files = [1000, 10000]
+    args.func(args)
+
+
+if __name__ == '__main__':
+    bench()
@@ -13,6 +13,7 @@ _parser.add_argument('--flac_bin', metavar='PATH')
 _parser.add_argument('--metaflac_bin', metavar='PATH')
 _parser.add_argument('--umount_cmd', metavar='CMD')
 _parser.add_argument('--cdrom', metavar='PATH')
+_parser.add_argument('--drive', metavar='PATH', action='append')
 _parser.add_argument('--discid_cmd', metavar='CMD')
 _parser.add_argument('--eject_cmd', metavar='CMD')
 _parser.add_argument('--wait_cmd', metavar='CMD')
@@ -26,6 +27,9 @@ _parser.add_argument('-f', '--allow_wrong_length', action='store_true')
 _parser.add_argument('-d', '--first_disc', metavar='N', type=int, default=1)
 _parser.add_argument('--nometa', action='store_true')
 _parser.add_argument('--extension', metavar='EXT', default='.flac')
+_parser.add_argument('--encode_jobs', metavar='N', type=int, default=0)
+_parser.add_argument('--spool_tracks', metavar='N', type=int, default=4)
+_parser.add_argument('--rip_log', metavar='FILE')
 _parser.add_argument('args', nargs='*')
 
 _args = _parser.parse_args()
@@ -35,6 +39,7 @@ args = _args.args
 dev_cdrom = _args.cdrom
 if not dev_cdrom:
     dev_cdrom = '/dev/cdrom'
+drives = _args.drive or []
 
 bin_wait = _args.wait_cmd
 bin_eject = _args.eject_cmd
@@ -54,6 +59,9 @@ allow_wrong_length = _args.allow_wrong_length
 first_disc = _args.first_disc
 nometa = _args.nometa
 extension = _args.extension
+encode_jobs = _args.encode_jobs
+spool_tracks = _args.spool_tracks
+rip_log = _args.rip_log
 
 
 def _parse_afp(specibus):
@@ -99,6 +107,8 @@ if not music_path:
 scratch_dir = None
 if 'Paths' in _config and 'scratch' in _config['Paths']:
     scratch_dir = _config['Paths']['scratch']
+if not rip_log and 'Paths' in _config and 'rip_log' in _config['Paths']:
+    rip_log = _config['Paths']['rip_log']
 
 # TODO: We really need to move all of this out of the module init.
 if libpath:
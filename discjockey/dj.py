@@ -2,7 +2,10 @@ import sys
 
 def main():
     cmd, *sys.argv[1:] = sys.argv[1:]
-    if cmd == 'beautify':
+    if cmd == 'bench':
+        from . import bench
+        bench.bench()
+    elif cmd == 'beautify':
         from . import beautify
         beautify.cosmetize()
     elif cmd == 'catalog':
@@ -0,0 +1,104 @@
+"""Just enough of Linux's inotify to watch a tree of directories, through
+ctypes so that we don't need anything beyond the standard library."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONTFOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+
+# Everything that can change what belongs in the cache.
+TREE_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+               | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+               | IN_MOVE_SELF)
+
+# struct inotify_event: wd, mask, cookie and the length of the name that
+# follows.
+EVENT_HEADER = struct.Struct('iIII')
+
+libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                   use_errno=True)
+libc.inotify_init1.argtypes = [ctypes.c_int]
+libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+
+class Watcher:
+    """Watches directories, one at a time; inotify doesn't do trees.  Each
+    directory is watched under a tag of the caller's choosing, and events come
+    back as (tag, name, mask) tuples, with an empty name for events about the
+    directory itself.  If the kernel's queue overflowed, and events were lost,
+    there's an event with a tag of None."""
+
+    def __init__(self):
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_init1: %s' % os.strerror(e))
+        self._tags = {}
+
+    def watch(self, path, tag):
+        """Start watching a directory.  Quietly does nothing if it has already
+        gone away."""
+        wd = libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                    TREE_EVENTS | IN_ONLYDIR | IN_DONTFOLLOW)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return
+            if e == errno.ENOSPC:
+                raise Exception('Out of inotify watches; raise '
+                                'fs.inotify.max_user_watches')
+            raise OSError(e, 'inotify_add_watch %s: %s'
+                          % (path, os.strerror(e)))
+        self._tags[wd] = tag
+
+    def read(self, timeout=None):
+        """Returns the events that are waiting, waiting up to `timeout`
+        seconds (or forever) for the first.  Returns [] on timeout."""
+        (readable, _, _) = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self._fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(data):
+            (wd, mask, _, length) = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, '', mask))
+            elif mask & IN_IGNORED:
+                self._tags.pop(wd, None)
+            elif wd in self._tags:
+                events.append((self._tags[wd], name, mask))
+                if mask & IN_MOVE_SELF:
+                    # The watch follows the directory, but we'd go on
+                    # reporting its old tag.  Whoever sees it arrive at the
+                    # new path will watch it again.
+                    libc.inotify_rm_watch(self._fd, wd)
+                    del self._tags[wd]
+        return events
+
+    def close(self):
+        os.close(self._fd)
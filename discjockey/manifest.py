@@ -0,0 +1,204 @@
+import json
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+MANIFEST_FILENAME = '.discjockey.db'
+
+# Changes that haven't been committed to the database yet are also appended
+# to this journal, which is far cheaper than a commit.  If a run is killed,
+# the next one replays the journal, and so doesn't redo or even re-check
+# anything that was finished.
+JOURNAL_FILENAME = MANIFEST_FILENAME + '.run'
+
+# Commit to the database every so often, which empties the journal.
+COMMIT_INTERVAL = 500
+
+
+def exists(cache_dir):
+    return os.path.isfile(os.path.join(cache_dir, MANIFEST_FILENAME))
+
+
+def is_manifest_file(filename):
+    """Whether a file in the root of the cache belongs to the manifest,
+    including SQLite's journal files."""
+    return filename.startswith(MANIFEST_FILENAME)
+
+
+class Manifest:
+    """Records, for every entry in a cache, the source it was built from and
+    how it was built, so that an incremental run can tell that the entry is up
+    to date from a single stat of the source.
+
+    Entries are keyed by their path relative to the root of the cache.  A
+    read-only manifest must already exist, and sees, but doesn't replay, the
+    journal of a run that was killed.
+
+    An entry can also carry a signature of its source, so that a run can
+    tell whether a source whose stat no longer matches really changed.  The
+    signature is only worth working out again when the stat changes."""
+
+    def __init__(self, cache_dir, readonly=False):
+        path = os.path.join(cache_dir, MANIFEST_FILENAME)
+        self._journal_path = os.path.join(cache_dir, JOURNAL_FILENAME)
+        self._journal = None
+        self._readonly = readonly
+        self._lock = threading.Lock()
+        if readonly:
+            self._db = sqlite3.connect(
+                    'file:%s?mode=ro' % urllib.parse.quote(path), uri=True,
+                    check_same_thread=False)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                             'out_path TEXT PRIMARY KEY, src_path TEXT, '
+                             'size INTEGER, mtime INTEGER, ino INTEGER, '
+                             'settings TEXT, audio TEXT, tags TEXT)')
+            columns = [row[1] for row in
+                       self._db.execute('PRAGMA table_info(entries)')]
+            if 'audio' not in columns:
+                # From before we kept signatures.
+                self._db.execute('ALTER TABLE entries ADD COLUMN audio TEXT')
+                self._db.execute('ALTER TABLE entries ADD COLUMN tags TEXT')
+        # Every run looks at every entry, so just slurp them all up front.
+        self._entries = {}
+        self._signatures = {}
+        for (out_path, size, mtime, ino, settings, audio,
+             tags) in self._db.execute(self._select()):
+            self._entries[out_path] = (size, mtime, ino, settings)
+            if audio is not None:
+                self._signatures[out_path] = (audio, tags)
+        self._uncommitted = 0
+        if not readonly:
+            self._journal = open(self._journal_path, 'a')
+        self._replay_journal()
+
+    def _select(self):
+        # A read-only manifest may be from before we kept signatures.
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(entries)')]
+        if 'audio' in columns:
+            return ('SELECT out_path, size, mtime, ino, settings, audio, tags '
+                    'FROM entries')
+        return ('SELECT out_path, size, mtime, ino, settings, NULL, NULL '
+                'FROM entries')
+
+    def _replay_journal(self):
+        try:
+            with open(self._journal_path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                op = json.loads(line)
+            except ValueError:
+                # The run died halfway through writing this line.
+                break
+            if op[0] == 'record':
+                self._record(op[1], op[2], tuple(op[3:7]),
+                             tuple(op[7:9]) or None)
+            elif op[0] == 'forget':
+                self._forget(op[1])
+        if not self._readonly:
+            self._commit()
+
+    def check(self, out_path, src_stat, settings):
+        """Returns True if the entry was built from this exact source with
+        these settings, False if it was built from something else, and None if
+        we've never heard of it."""
+        entry = self._entries.get(out_path)
+        if entry is None:
+            return None
+        return entry == (src_stat.st_size, src_stat.st_mtime_ns,
+                         src_stat.st_ino, settings)
+
+    def signature(self, out_path, settings):
+        """Returns the signature that was recorded for the entry's source, if
+        the entry was built with these settings and has one."""
+        entry = self._entries.get(out_path)
+        if entry is None or entry[3] != settings:
+            return None
+        return self._signatures.get(out_path)
+
+    def record(self, out_path, src_path, src_stat, settings, signature=None):
+        """`signature`, if given, is a pair of strings."""
+        entry = (src_stat.st_size, src_stat.st_mtime_ns, src_stat.st_ino,
+                 settings)
+        if signature is not None:
+            signature = tuple(signature)
+        with self._lock:
+            if (self._entries.get(out_path) == entry
+                    and self._signatures.get(out_path) == signature):
+                return
+            self._log(['record', out_path, src_path] + list(entry)
+                      + list(signature or []))
+            self._record(out_path, src_path, entry, signature)
+            self._wrote()
+
+    def forget(self, out_path):
+        with self._lock:
+            if out_path in self._entries:
+                self._log(['forget', out_path])
+                self._forget(out_path)
+                self._wrote()
+
+    def forget_tree(self, out_dir):
+        """Forget every entry under a directory."""
+        prefix = os.path.join(out_dir, '')
+        with self._lock:
+            for p in [p for p in self._entries if p.startswith(prefix)]:
+                self._log(['forget', p])
+                self._forget(p)
+                self._wrote()
+
+    def _record(self, out_path, src_path, entry, signature):
+        self._entries[out_path] = entry
+        if signature is None:
+            self._signatures.pop(out_path, None)
+        else:
+            self._signatures[out_path] = signature
+        if not self._readonly:
+            self._db.execute('INSERT OR REPLACE INTO entries '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (out_path, src_path) + entry
+                             + (signature or (None, None)))
+
+    def _forget(self, out_path):
+        self._signatures.pop(out_path, None)
+        if self._entries.pop(out_path, None) is not None:
+            if not self._readonly:
+                self._db.execute('DELETE FROM entries WHERE out_path = ?',
+                                 (out_path,))
+
+    def _log(self, op):
+        # Flushing hands the line to the kernel, which is enough to survive
+        # the process being killed.  Losing it to a power cut just means that
+        # the next run checks the output the slow way.
+        self._journal.write(json.dumps(op) + '\n')
+        self._journal.flush()
+
+    def _wrote(self):
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_INTERVAL:
+            self._commit()
+
+    def _commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+        if self._journal:
+            self._journal.truncate(0)
+
+    def commit(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            if not self._readonly:
+                self._commit()
+                self._journal.close()
+                os.unlink(self._journal_path)
+            self._db.close()
@@ -0,0 +1,134 @@
+"""Where a transcode run spends its time, and what it did, for graphing.
+
+Metrics come out as JSON, and optionally in the format of node_exporter's
+textfile collector.  Stage timings are cumulative wall time, and count any
+stages nested inside them; work on the I/O pool is timed where it runs, so
+the stages it counts towards can add up to more than the run took.  CPU time
+is per tool, from the rusage of the children that ran it."""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+PROMETHEUS_PREFIX = 'discjockey_transcode_'
+
+
+class Metrics:
+    """Counters and timers for one run, safe to update from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new run, for a sync that goes on running."""
+        with self._lock:
+            self.started = time.time()
+            self._start = time.perf_counter()
+            self.stages = {}
+            self.cpu = collections.Counter()
+            self.actions = collections.Counter()
+            self.bytes = collections.Counter()
+            self.spawns = 0
+            self.files = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            (total, calls) = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, calls + 1)
+
+    def add_cpu(self, tool, seconds):
+        with self._lock:
+            self.cpu[tool] += seconds
+
+    def action(self, name, bytes_read=0, bytes_written=0):
+        with self._lock:
+            self.actions[name] += 1
+            self.bytes['read'] += bytes_read
+            self.bytes['written'] += bytes_written
+
+    def spawned(self):
+        with self._lock:
+            self.spawns += 1
+
+    def file(self, **fields):
+        """Record the timings for one file."""
+        with self._lock:
+            self.files.append(fields)
+
+    def to_dict(self, ok):
+        with self._lock:
+            return {
+                'started': self.started,
+                'seconds': time.perf_counter() - self._start,
+                'ok': ok,
+                'stages': {name: {'seconds': total, 'calls': calls}
+                           for (name, (total, calls)) in self.stages.items()},
+                'cpu_seconds': dict(self.cpu),
+                'actions': dict(self.actions),
+                'bytes': dict(self.bytes),
+                'spawns': self.spawns,
+                'files': list(self.files),
+            }
+
+    def write_json(self, path, ok):
+        _write_atomically(path, json.dumps(self.to_dict(ok), indent=2))
+
+    def write_prometheus(self, path, ok):
+        """Write the totals for the textfile collector.  Per-file timings
+        are left out; they'd make a series per track."""
+        d = self.to_dict(ok)
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append('# HELP %s%s %s' % (PROMETHEUS_PREFIX, name,
+                                             help_text))
+            lines.append('# TYPE %s%s %s' % (PROMETHEUS_PREFIX, name, kind))
+            for (labels, value) in samples:
+                lines.append('%s%s%s %s' % (PROMETHEUS_PREFIX, name, labels,
+                                            repr(float(value))))
+
+        family('last_run_timestamp_seconds', 'gauge',
+               'When the last run started.', [('', d['started'])])
+        family('last_run_seconds', 'gauge', 'How long the last run took.',
+               [('', d['seconds'])])
+        family('last_run_ok', 'gauge', 'Whether the last run succeeded.',
+               [('', int(ok))])
+        family('stage_seconds', 'gauge', 'Wall time spent in each stage.',
+               [('{stage="%s"}' % name, s['seconds'])
+                for (name, s) in sorted(d['stages'].items())])
+        family('stage_calls', 'gauge', 'Times each stage was entered.',
+               [('{stage="%s"}' % name, s['calls'])
+                for (name, s) in sorted(d['stages'].items())])
+        family('cpu_seconds', 'gauge', 'CPU time used by each tool.',
+               [('{tool="%s"}' % tool, seconds)
+                for (tool, seconds) in sorted(d['cpu_seconds'].items())])
+        family('actions', 'gauge', 'Cache entries by what was done.',
+               [('{action="%s"}' % name, n)
+                for (name, n) in sorted(d['actions'].items())])
+        family('bytes', 'gauge', 'Bytes of audio read and written.',
+               [('{direction="%s"}' % direction, n)
+                for (direction, n) in sorted(d['bytes'].items())])
+        family('spawns', 'gauge', 'Processes started.',
+               [('', d['spawns'])])
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def _write_atomically(path, text):
+    # The textfile collector may read at any moment, so never let it see a
+    # half-written file.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -38,6 +38,13 @@ def prevent_sleep():
                 ES_CONTINUOUS | ES_SYSTEM_REQUIRED)
 
 
+def _command(cmd, device):
+    """Split a configured command, putting the device in place of any
+    {device} in it."""
+    return [arg.replace('{device}', device or config.dev_cdrom)
+            for arg in cmd.split(' ')]
+
+
 #
 # wait_for_disc
 #
@@ -62,7 +69,7 @@ def _disc_ready(cdrom_device):
         return True
     elif LINUX:
         ret = subprocess.call(
-                ['/usr/bin/cd-discid', config.dev_cdrom],
+                ['/usr/bin/cd-discid', cdrom_device or config.dev_cdrom],
                 stderr=subprocess.DEVNULL)
         return not ret
     elif CYGWIN:
@@ -75,12 +82,26 @@ def _disc_ready(cdrom_device):
         return b'There is a problem with your media device' not in ret
 
 
-def wait_for_disc():
+def wait_for_disc(device=None, stop=None):
+    """Wait for a disc in the drive.  Returns False if the `stop` event is
+    set first."""
     if config.bin_wait:
-        subprocess.check_output(config.bin_wait.split(' '))
-        return
+        proc = subprocess.Popen(_command(config.bin_wait, device),
+                                stdout=subprocess.DEVNULL)
+        while True:
+            try:
+                ret = proc.wait(timeout=None if stop is None else 1)
+                break
+            except subprocess.TimeoutExpired:
+                if stop.is_set():
+                    proc.terminate()
+                    proc.wait()
+                    return False
+        if ret:
+            raise subprocess.CalledProcessError(ret, proc.args)
+        return True
 
-    cdrom_device = None
+    cdrom_device = device
     if MAC_OS:
         while True:
             cdrom_device = _get_cdrom_device_if_drive_ready()
@@ -89,20 +110,25 @@ def wait_for_disc():
             time.sleep(1)
 
     while not _disc_ready(cdrom_device):
-        time.sleep(1)
+        if stop is None:
+            time.sleep(1)
+        elif stop.wait(1):
+            return False
+    return True
 
 
 #
 # eject_disc
 #
 
-def eject_disc():
+def eject_disc(device=None):
     if config.bin_eject:
-        subprocess.check_output(config.bin_eject.split(' '))
+        subprocess.check_output(_command(config.bin_eject, device))
     elif MAC_OS:
         subprocess.check_output(['/usr/bin/drutil', 'eject'])
     elif LINUX:
-        subprocess.check_output(['/usr/bin/eject', '/dev/cdrom'])
+        subprocess.check_output(['/usr/bin/eject',
+                                 device or config.dev_cdrom])
     elif CYGWIN:
         subprocess.check_output(['/usr/bin/cdrecord', '-eject'])
     elif WINDOWS:
@@ -114,14 +140,14 @@ def eject_disc():
 # get_discid
 #
 
-def get_discid():
+def get_discid(device=None):
     if WINDOWS:
-        p = subprocess.Popen(config.bin_discid.split(' '),
+        p = subprocess.Popen(_command(config.bin_discid, device),
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         out, err = p.communicate()
         return out + err
     if config.bin_discid:
-        return subprocess.check_output(config.bin_discid.split(' '))
+        return subprocess.check_output(_command(config.bin_discid, device))
 
     if MAC_OS:
         cdrom_device = _get_cdrom_device_if_drive_ready()
@@ -129,7 +155,7 @@ def get_discid():
                                         cdrom_device])
 
     else:
-        cdrom_device = config.dev_cdrom
+        cdrom_device = device or config.dev_cdrom
         return subprocess.check_output(['/usr/bin/cd-discid', cdrom_device])
 
 
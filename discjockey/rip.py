@@ -1,14 +1,26 @@
 # Copyright (c) 2013-2023 John Leen
 
+import concurrent.futures
+import functools
+import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unicodedata
 import uuid
 
+from discjockey import audiofile, riplog, tagging
+
 
 playlist_extension = '.m3u'
 
+# Kept in the album's directory while it's being ripped.
+JOURNAL_FILENAME = '.discjockey-rip'
+
 DISC_DELIMITER = uuid.uuid4()
 SKIPPED_TRACK = uuid.uuid4()
 
@@ -203,6 +215,7 @@ def rename_files(tracks, album_path, track_extension):
                         (len(tracks), len(files)))
     files.sort()
 
+    retags = []
     for (linear_num, (old_name, track)) in enumerate(zip(files, tracks), 1):
         new_name = track['filename']
         # Don't try to rename a file if the old and new names are Unicode
@@ -217,15 +230,23 @@ def rename_files(tracks, album_path, track_extension):
             os.rename(os.path.join(path, old_name),
                       os.path.join(path, new_name))
         if track_extension == '.flac':
-            subprocess.check_output([
-                platform.bin_metaflac(),
-                '--remove-all-tags',
-                '--set-tag=GENRE=%s' % track['genre'],
-                '--set-tag=ARTIST=%s' % track['artist'],
-                '--set-tag=ALBUM=%s' % track['album'],
-                '--set-tag=TITLE=%s' % track['title'],
-                '--set-tag=TRACKNUMBER=%d' % linear_num,
-                os.path.join(path, new_name)])
+            retags.append((os.path.join(path, new_name), track_tags(
+                    track, linear_num)))
+
+    # Retagging is mostly waiting on the disk, so do the whole album at once.
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        for _ in pool.map(lambda retag: tagging.retag_flac(*retag), retags):
+            pass
+
+
+def track_tags(track, linear_num):
+    """The tags that a ripped track gets, for the tagging module."""
+    return [(key, value.encode('utf-8')) for (key, value) in [
+            (b'genre', track['genre']),
+            (b'artist', track['artist']),
+            (b'album', track['album']),
+            (b'title', track['title']),
+            (b'tracknumber', '%d' % linear_num)]]
 
 
 def dissect_track_path(track_path):
@@ -246,87 +267,663 @@ def assert_disc_length(disc_len):
         sys.exit(1)
 
 
-def assert_first_disc_length(tracks):
-    disc_tracksets = divide_tracks_by_disc(tracks)
-    first_disc_tracks = disc_tracksets[config.first_disc - 1]
-    assert_disc_length(len(first_disc_tracks))
-
+def assert_first_disc_length(tracks, album_path, journal):
+    """Check the first disc that still needs ripping, which should be the
+    one in the drive."""
+    for (_, disc_tracks, _) in album_discs(tracks):
+        if not journal.disc_done(disc_tracks, album_path):
+            assert_disc_length(len(disc_tracks))
+            return
 
-def rip_and_encode(tracks, album_path):
-    disc_tracksets = divide_tracks_by_disc(tracks)
 
-    num_discs = len(disc_tracksets)
-    disc_num = config.first_disc
+def album_discs(tracks):
+    """Yields (disc number, tracks, number of its first track) for the discs
+    of an album that we're ripping."""
     linear_num = 1
-
-    for disc_tracks in disc_tracksets[disc_num - 1:]:
-        if disc_num > config.first_disc:
-            print(("--- Insert disc %d of %d ---" % (disc_num, num_discs)))
-            platform.wait_for_disc()
-        disc_num += 1
-
-        assert_disc_length(len(disc_tracks))
-
+    for (disc_num, disc_tracks) in enumerate(divide_tracks_by_disc(tracks),
+                                             start=1):
+        if disc_num >= config.first_disc:
+            yield disc_num, disc_tracks, linear_num
+            linear_num += count_tracks(disc_tracks)
+
+
+class RipJournal:
+    """Which tracks of an album have been ripped and verified, so that a rip
+    that's interrupted can pick up where it left off.  It's a file of JSON
+    lines in the album's directory, one per track, recording the size and
+    the audio MD5 from STREAMINFO, which flac -V has checked against what was
+    ripped."""
+
+    def __init__(self, album_dir):
+        self._path = os.path.join(album_dir, JOURNAL_FILENAME)
+        self._lock = threading.Lock()
+        self._done = {}
+        try:
+            with open(self._path, 'r') as f:
+                lines = f.readlines()
+            self.resuming = True
+        except FileNotFoundError:
+            lines = []
+            self.resuming = False
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The rip died halfway through writing this line.
+                break
+            self._done[entry['filename']] = entry
+
+    def track_done(self, output_file):
+        """Whether a track was ripped, and is still there as it was."""
+        entry = self._done.get(os.path.basename(output_file))
+        if entry is None:
+            return False
+        try:
+            return (os.path.getsize(output_file) == entry['size']
+                    and audiofile.audio_fingerprint(output_file)
+                    == entry['audio'])
+        except Exception:
+            return False
+
+    def disc_done(self, disc_tracks, album_path):
+        return all(self.track_done(track_path(album_path, track))
+                   for track in disc_tracks if track != SKIPPED_TRACK)
+
+    def start(self):
+        """Start the journal, if it isn't already, so that even a rip that
+        fails on the first track can be picked up again."""
+        with open(self._path, 'a'):
+            pass
+
+    def record(self, output_file):
+        entry = {'filename': os.path.basename(output_file),
+                 'size': os.path.getsize(output_file),
+                 'audio': audiofile.audio_fingerprint(output_file)}
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self._done[entry['filename']] = entry
+
+    def finish(self):
+        """The whole album is ripped, so we're done with the journal."""
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+def flac_command(output_file, track, linear_num):
+    """flac, reading a WAV on stdin, and checking that what it wrote decodes
+    to the same audio."""
+    return [platform.bin_flac(), '-s', '-V', '-', '-o', output_file,
+            '-T', 'TITLE=%s' % (track['title']),
+            '-T', 'ALBUM=%s' % (track['album']),
+            '-T', 'ARTIST=%s' % (track['artist']),
+            '-T', 'GENRE=%s' % (track['genre']),
+            '-T', 'TRACKNUMBER=%d' % linear_num]
+
+
+def cdparanoia_command(track_num, wav_path, device=None):
+    """cdparanoia, reporting what it does on stderr for riplog to read."""
+    cmd = [platform.bin_cdparanoia(), '-e']
+    if device:
+        cmd += ['-d', device]
+    return cmd + ['%d' % track_num, wav_path]
+
+
+def read_paranoia(rip_proc, device):
+    """Start reading a cdparanoia's stderr.  With several drives going at
+    once, their progress would be a jumble, so it's only shown for the one
+    drive."""
+    return riplog.ParanoiaReader(rip_proc.stderr, echo=device is None)
+
+
+# The cdparanoia and flac processes that the drives have going, outside of
+# an EncodePool, so that an interrupted rip_queue can stop them all.
+_procs_lock = threading.Lock()
+_procs = set()
+_aborting = False
+
+
+def start_process(cmd, **kwargs):
+    with _procs_lock:
+        if _aborting:
+            raise Exception('Aborted')
+        proc = subprocess.Popen(cmd, **kwargs)
+        _procs.add(proc)
+    return proc
+
+
+def end_process(*procs):
+    with _procs_lock:
+        for proc in procs:
+            _procs.discard(proc)
+
+
+def abort_processes():
+    """Stop every process that start_process started, and any that it's
+    asked to start from now on.  Each rip then cleans up after itself as it
+    fails."""
+    global _aborting
+    with _procs_lock:
+        _aborting = True
+        for proc in _procs:
+            proc.terminate()
+
+
+def wait_child(proc):
+    """Wait for a child process, returning the CPU time it took, or None where
+    there's no telling (on Windows)."""
+    if not hasattr(os, 'wait4'):
+        proc.wait()
+        return None
+    (_, status, rusage) = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+class EncodePool:
+    """Encodes ripped tracks on a pool of flac processes, so that the drive
+    can get on with the next track instead of waiting for flac.  Ripped tracks
+    wait for a worker in a spool of WAV files, which holds at most
+    `spool_tracks` of them.
+
+    Unless `fail_fast` is False, a failed encode is raised by the next call to
+    encode or wait."""
+
+    def __init__(self, jobs, spool_tracks, fail_fast=True):
+        self._pool = concurrent.futures.ThreadPoolExecutor(jobs)
+        self._spool_slots = threading.Semaphore(spool_tracks)
+        self._fail_fast = fail_fast
+        self._lock = threading.Lock()
+        self._procs = set()
+        self._aborting = False
+        self._futures = []
+
+    def wait_for_spool(self):
+        """Block until there's room in the spool for another track."""
+        self._spool_slots.acquire()
+
+    def unspool(self):
+        """Give back the room that wait_for_spool made, for a track that
+        didn't get ripped after all."""
+        self._spool_slots.release()
+
+    def encode(self, wav_path, output_file, track, linear_num, done=None):
+        """Encode a spooled track, which takes its place in the spool until
+        it's done, and then call `done`, if given, with the time the encode
+        took and its CPU time.  Returns the Future of the encode.  Raises the
+        error of any encode that has already failed, so that we don't go on
+        ripping for nothing."""
+        future = self._pool.submit(
+                self._encode, wav_path, output_file, track, linear_num, done)
+        self._futures.append(future)
+        if self._fail_fast:
+            for f in self._futures:
+                if f.done():
+                    f.result()
+        return future
+
+    def wait(self):
+        """Wait for the encodes so far, raising the first error."""
+        for future in self._futures:
+            if self._fail_fast:
+                future.result()
+            else:
+                concurrent.futures.wait([future])
+
+    def abort(self):
+        with self._lock:
+            self._aborting = True
+            for proc in self._procs:
+                proc.terminate()
+        for future in self._futures:
+            if future.cancel():
+                # It will never run to give back its place in the spool, and
+                # a drive may be waiting for it.
+                self._spool_slots.release()
+
+    def close(self):
+        self._pool.shutdown()
+
+    def _encode(self, wav_path, output_file, track, linear_num, done):
+        encode_proc = None
+        try:
+            with open(wav_path, 'rb') as wav_fd:
+                with self._lock:
+                    if self._aborting:
+                        raise Exception('Aborted')
+                    start = time.perf_counter()
+                    encode_proc = subprocess.Popen(
+                            flac_command(output_file, track, linear_num),
+                            stdin=wav_fd, stdout=subprocess.DEVNULL)
+                    self._procs.add(encode_proc)
+                encode_cpu = wait_child(encode_proc)
+                encode_seconds = time.perf_counter() - start
+            if encode_proc.returncode != 0:
+                raise Exception('Abnormal flac termination')
+            os.remove(wav_path)
+        except (Exception, KeyboardInterrupt):
+            if encode_proc is not None:
+                encode_proc.terminate()
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+        finally:
+            if encode_proc is not None:
+                with self._lock:
+                    self._procs.discard(encode_proc)
+            self._spool_slots.release()
+        if done:
+            done(encode_seconds, encode_cpu)
+
+
+def rip_track(track_num, track, output_file, linear_num, device=None):
+    """Rip a track straight into flac.  Returns how the read went, if we did
+    it, the time the encode took, and its CPU time."""
+    rip_proc = None
+    encode_proc = None
+    read = None
+    try:
         if config.rip_bin:
-            subprocess.check_output(
-                    [config.rip_bin] + config.rip_args.split(' '))
+            scratch_wav = os.path.join(
+                    config.scratch_dir, '%02d.wav' % track_num)
+            rip_fd = open(scratch_wav, 'rb')
+        else:
+            rip_cmd = cdparanoia_command(track_num, '-', device)
+            rip_proc = start_process(rip_cmd,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            paranoia = read_paranoia(rip_proc, device)
+            rip_fd = rip_proc.stdout
+        start = time.perf_counter()
+        encode_proc = start_process(
+                flac_command(output_file, track, linear_num),
+                stdin=rip_fd, stdout=subprocess.DEVNULL)
+        if rip_proc:
+            rip_proc.stdout.close()
+        encode_cpu = wait_child(encode_proc)
+        # Which, streaming, includes waiting for the drive.
+        encode_seconds = time.perf_counter() - start
+        if rip_proc:
+            if rip_proc.wait() != 0:
+                raise Exception('Abnormal cdparanoia termination')
+            read = paranoia.finish()
+        if encode_proc.returncode != 0:
+            raise Exception('Abnormal flac termination')
 
-        for (track_num, track) in enumerate(disc_tracks, start=1):
-            if track == SKIPPED_TRACK:
+        if config.rip_bin:
+            rip_fd.close()
+            os.remove(scratch_wav)
+        return read, encode_seconds, encode_cpu
+    except (Exception, KeyboardInterrupt):
+        if encode_proc is not None:
+            encode_proc.terminate()
+        if rip_proc is not None:
+            rip_proc.terminate()
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+    finally:
+        end_process(rip_proc, encode_proc)
+
+
+def spool_track(track_num, track, output_file, linear_num, encoder,
+                spool_dir, device=None, done=None):
+    """Rip a track into the spool, and leave it for the encoder, which calls
+    `done` once it's encoded, with how the read went, if we did it, and then
+    what the encoder passes to its own `done`.  Returns the Future of the
+    encode."""
+    encoder.wait_for_spool()
+    read = None
+    if config.rip_bin:
+        # It's already been ripped.
+        wav_path = os.path.join(config.scratch_dir, '%02d.wav' % track_num)
+    else:
+        wav_path = os.path.join(spool_dir, '%s.wav' % uuid.uuid4())
+        rip_proc = None
+        try:
+            rip_proc = start_process(
+                    cdparanoia_command(track_num, wav_path, device),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            paranoia = read_paranoia(rip_proc, device)
+            if rip_proc.wait() != 0:
+                raise Exception('Abnormal cdparanoia termination')
+            read = paranoia.finish()
+        except (Exception, KeyboardInterrupt):
+            if rip_proc is not None:
+                rip_proc.terminate()
+            if os.path.exists(wav_path):
+                os.remove(wav_path)
+            # Otherwise every failed read would leave the spool a track
+            # smaller, until the drives were stuck waiting for it.
+            encoder.unspool()
+            raise
+        finally:
+            end_process(rip_proc)
+    return encoder.encode(wav_path, output_file, track, linear_num,
+                          done and functools.partial(done, read))
+
+
+def track_path(album_path, track):
+    return os.path.join(platform.music_path, album_path, track['filename'])
+
+
+def track_ripped(journal, stats, fraction, track, output_file, read,
+                 encode_seconds, encode_cpu):
+    journal.record(output_file)
+    stats.track(fraction, track['title'], output_file, read, encode_seconds,
+                encode_cpu)
+
+
+def rip_disc(disc_tracks, album_path, linear_num, journal, stats,
+             encoder=None, spool_dir=None, device=None, prefix=''):
+    """Rip the tracks of one disc that the journal doesn't have, numbering
+    them from linear_num, and telling `stats`, a riplog.DiscStats, how each
+    one went.  Returns the encodes that are still going, if there's an
+    encoder."""
+    encodes = []
+    for (track_num, track) in enumerate(disc_tracks, start=1):
+        if track == SKIPPED_TRACK:
+            continue
+
+        output_file = track_path(album_path, track)
+        fraction = f'{prefix}[{track_num}/{len(disc_tracks)}]'
+        if journal.track_done(output_file):
+            riplog.say(f'{fraction} Already ripped {track["title"]}')
+            linear_num += 1
+            continue
+        if os.path.exists(output_file):
+            # Half written by a rip that was interrupted, and flac won't
+            # write over it.
+            os.remove(output_file)
+        lines = [f'{fraction} Ripping {track["title"]}']
+        if track['set']:
+            lines.append(f'{" " * len(fraction)} from {track["set"]}')
+        riplog.say(*lines, '')
+
+        stats.expect()
+        ripped = functools.partial(track_ripped, journal, stats, fraction,
+                                   track, output_file)
+        if encoder:
+            encodes.append(spool_track(
+                    track_num, track, output_file, linear_num, encoder,
+                    spool_dir, device, ripped))
+        else:
+            ripped(*rip_track(track_num, track, output_file, linear_num,
+                              device))
+        linear_num += 1
+    stats.done_reading()
+    return encodes
+
+
+def count_tracks(disc_tracks):
+    return len([track for track in disc_tracks if track != SKIPPED_TRACK])
+
+
+def rip_and_encode(tracks, album_path, journal):
+    num_discs = len(divide_tracks_by_disc(tracks))
+
+    # With --encode_jobs, the drive reads while flac encodes what it's read,
+    # even while we wait for the next disc.
+    encoder = None
+    spool_dir = None
+    if config.encode_jobs:
+        encoder = EncodePool(config.encode_jobs, config.spool_tracks)
+        spool_dir = tempfile.mkdtemp(prefix='dj-spool-',
+                                     dir=config.scratch_dir)
+
+    log = riplog.RipLog(config.rip_log)
+    journal.start()
+    try:
+        # The first disc that needs ripping should already be in the drive.
+        need_disc = False
+        for (disc_num, disc_tracks, linear_num) in album_discs(tracks):
+            if journal.disc_done(disc_tracks, album_path):
+                print("--- Disc %d of %d is already ripped ---"
+                      % (disc_num, num_discs))
                 continue
-
-            fraction = f'[{track_num}/{len(disc_tracks)}]'
-            print(f'{fraction} Ripping {track["title"]}')
-            if track['set']:
-                print(f'{" " * len(fraction)} from {track["set"]}')
-            print()
-
-            output_file = os.path.join(
-                    platform.music_path, album_path,
-                    track['filename'])
-            rip_proc = None
-            encode_proc = None
+            if need_disc:
+                print(("--- Insert disc %d of %d ---"
+                       % (disc_num, num_discs)))
+                platform.wait_for_disc()
+            need_disc = True
+
+            assert_disc_length(len(disc_tracks))
+
+            if config.rip_bin:
+                if encoder:
+                    # The ripper reuses the scratch files of the last disc.
+                    encoder.wait()
+                subprocess.check_output(
+                        [config.rip_bin] + config.rip_args.split(' '))
+
+            stats = riplog.DiscStats(log, config.dev_cdrom, album_path,
+                                     disc_num, num_discs)
+            rip_disc(disc_tracks, album_path, linear_num, journal, stats,
+                     encoder, spool_dir)
+
+            platform.eject_disc()
+
+        if encoder:
+            encoder.wait()
+        journal.finish()
+    except (Exception, KeyboardInterrupt):
+        if encoder:
+            encoder.abort()
+        raise
+    finally:
+        if encoder:
+            encoder.close()
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+def disc_ids(track_list):
+    """The disc ID that a catalog entry pins each of its discs to, with a
+    `~d ID` line, or None for a disc that it doesn't pin."""
+    ids = [None]
+    for line in track_list:
+        line = line.strip()
+        if line.startswith('~~~'):
+            ids.append(None)
+        elif line.startswith('~d '):
+            ids[-1] = line.split(' ', 1)[1].strip()
+    return ids
+
+
+class DiscQueue:
+    """The discs that we're waiting to rip, from every album in the queue,
+    for the drives to claim as discs go into them.  A disc is finished once
+    it's been ripped and encoded, or has failed."""
+
+    def __init__(self, discs):
+        self._lock = threading.Lock()
+        self._waiting = list(discs)
+        self._unfinished = len(discs)
+        self._claimed_ids = set()
+        self.failed = []
+        # Also set to stop the drives early.
+        self.finished = threading.Event()
+        if not discs:
+            self.finished.set()
+
+    def claim(self, disc_id, num_tracks):
+        """Returns the disc in the queue that a disc with this ID and track
+        count is, or None if there isn't one.  A disc pinned to the ID wins;
+        otherwise it's the first disc that isn't pinned to another ID and has
+        the right number of tracks.  A disc that we've already seen only
+        matches a pin, so that putting a disc in twice doesn't rip it as some
+        other disc with the same number of tracks."""
+        with self._lock:
+            pinned = [disc for disc in self._waiting
+                      if disc['disc_id'] == disc_id]
+            unpinned = [disc for disc in self._waiting
+                        if disc['disc_id'] is None
+                        and disc_id not in self._claimed_ids]
+            matches = (pinned
+                       or [disc for disc in unpinned
+                           if len(disc['tracks']) == num_tracks])
+            if not matches and config.allow_wrong_length:
+                matches = unpinned
+            if not matches:
+                return None
+            disc = matches[0]
+            self._waiting.remove(disc)
+            self._claimed_ids.add(disc_id)
+            return disc
+
+    def finish(self, disc, error=None):
+        if error:
+            riplog.say('%sFailed to rip %s: %s'
+                       % (disc['prefix'], disc['label'], error))
+        else:
+            riplog.say('%sFinished %s' % (disc['prefix'], disc['label']))
+        with self._lock:
+            if error:
+                self.failed.append(disc)
+            self._unfinished -= 1
+            if not self._unfinished:
+                self.finished.set()
+
+    def finish_after(self, disc, encodes):
+        """Finish the disc once its encodes are done."""
+        if not encodes:
+            self.finish(disc)
+            return
+        remaining = [len(encodes)]
+        lock = threading.Lock()
+
+        def encoded(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [e.exception() for e in encodes if not e.cancelled()]
+            errors = [e for e in errors if e is not None]
+            self.finish(disc, errors[0] if errors else None)
+
+        for future in encodes:
+            future.add_done_callback(encoded)
+
+
+def rip_from_drive(device, queue, encoder, spool_dir, log):
+    """Rip whatever discs from the queue go into one drive, until the queue
+    is finished."""
+    prefix = '[%s] ' % os.path.basename(device)
+    try:
+        while True:
+            riplog.say(prefix + '--- Insert a disc ---')
+            if not platform.wait_for_disc(device, queue.finished):
+                return
+            fields = platform.get_discid(device).split(b' ')
+            (disc_id, num_tracks) = (fields[0].decode('ascii'),
+                                     int(fields[1]))
+            disc = queue.claim(disc_id, num_tracks)
+            if disc is None:
+                riplog.say('%sNo disc in the queue matches disc %s with %d '
+                           'tracks' % (prefix, disc_id, num_tracks))
+                platform.eject_disc(device)
+                continue
+            disc['prefix'] = prefix
+            riplog.say(prefix + 'Ripping ' + disc['label'])
+            stats = riplog.DiscStats(log, device, disc['album_path'],
+                                     disc['disc_num'], disc['num_discs'],
+                                     prefix)
             try:
-                if config.rip_bin:
-                    scratch_wav = os.path.join(
-                            config.scratch_dir, '%02d.wav' % track_num)
-                    rip_fd = open(scratch_wav, 'rb')
-                else:
-                    rip_cmd = [platform.bin_cdparanoia(),
-                               '%d' % track_num, '-']
-                    rip_proc = subprocess.Popen(rip_cmd,
-                            stdout=subprocess.PIPE)
-                    rip_fd = rip_proc.stdout
-                encode_proc = subprocess.Popen(
-                        [platform.bin_flac(), '-s', '-', '-o', output_file,
-                         '-T', 'TITLE=%s' % (track['title']),
-                         '-T', 'ALBUM=%s' % (track['album']),
-                         '-T', 'ARTIST=%s' % (track['artist']),
-                         '-T', 'GENRE=%s' % (track['genre']),
-                         '-T', 'TRACKNUMBER=%d' % linear_num],
-                        stdin=rip_fd, stdout=subprocess.PIPE)
-                if rip_proc:
-                    rip_proc.stdout.close()
-                encode_proc.communicate()
-                if rip_proc and rip_proc.wait() != 0:
-                    raise Exception('Abnormal cdparanoia termination')
-                if encode_proc.returncode != 0:
-                    raise Exception('Abnormal flac termination')
-
-                if config.rip_bin:
-                    rip_fd.close()
-                    os.remove(scratch_wav)
-            except (Exception, KeyboardInterrupt):
-                if encode_proc is not None:
-                    encode_proc.terminate()
-                if rip_proc is not None:
-                    rip_proc.terminate()
-                if os.path.exists(output_file):
-                    os.remove(output_file)
-                raise
-            linear_num += 1
-
-        platform.eject_disc()
+                encodes = rip_disc(disc['tracks'], disc['album_path'],
+                                   disc['linear_num'], disc['journal'],
+                                   stats, encoder, spool_dir, device, prefix)
+            except Exception as e:
+                queue.finish(disc, e)
+            else:
+                queue.finish_after(disc, encodes)
+            platform.eject_disc(device)
+    except Exception as e:
+        riplog.say('%sGiving up on the drive: %s' % (prefix, e))
+
+
+def rip_queue(album_paths):
+    """Rip every disc of every album in the queue, from all of the drives in
+    --drive at once, in whatever order the discs go in."""
+    if not platform.LINUX:
+        raise Exception('Ripping from several drives only works on Linux')
+    if config.rip_bin:
+        raise Exception("Can't rip from several drives with a rip binary")
+
+    discs = []
+    journals = {}
+    for album_path in album_paths:
+        (track_list, playlists) = read_album(album_path)
+        album_dir = os.path.join(platform.music_path, album_path)
+        journal = RipJournal(album_dir)
+        journals[album_path] = journal
+        if config.create_playlists:
+            write_playlists(playlists, album_dir, rename=journal.resuming)
+        tracks = playlists[0]['tracks']
+        num_discs = len(divide_tracks_by_disc(tracks))
+        ids = disc_ids(track_list)
+        for (disc_num, disc_tracks, linear_num) in album_discs(tracks):
+            label = '%s (disc %d of %d)' % (album_path, disc_num, num_discs)
+            if journal.disc_done(disc_tracks, album_path):
+                riplog.say('%s is already ripped' % label)
+                continue
+            journal.start()
+            discs.append({
+                'album_path': album_path,
+                'label': label,
+                'tracks': disc_tracks,
+                'disc_num': disc_num,
+                'num_discs': num_discs,
+                'linear_num': linear_num,
+                'disc_id': ids[disc_num - 1],
+                'journal': journal
+            })
+
+    queue = DiscQueue(discs)
+    log = riplog.RipLog(config.rip_log)
+    encoder = None
+    spool_dir = None
+    if config.encode_jobs:
+        # A disc that fails to encode mustn't stop the other drives.
+        encoder = EncodePool(config.encode_jobs, config.spool_tracks,
+                             fail_fast=False)
+        spool_dir = tempfile.mkdtemp(prefix='dj-spool-',
+                                     dir=config.scratch_dir)
+    drives = [threading.Thread(target=rip_from_drive,
+                               args=(device, queue, encoder, spool_dir,
+                                     log),
+                               daemon=True)
+              for device in config.drives]
+    try:
+        for drive in drives:
+            drive.start()
+        while not queue.finished.wait(1):
+            if not any(drive.is_alive() for drive in drives):
+                raise Exception('Every drive has given up')
+        # Let the drives stop waiting for discs.
+        for drive in drives:
+            drive.join()
+    except (Exception, KeyboardInterrupt):
+        queue.finished.set()
+        abort_processes()
+        if encoder:
+            encoder.abort()
+        # The drives remove what they didn't finish as their rips fail.
+        for drive in drives:
+            if drive.is_alive():
+                drive.join()
+        raise
+    finally:
+        if encoder:
+            encoder.close()
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+    failed_albums = set(disc['album_path'] for disc in queue.failed)
+    for (album_path, journal) in journals.items():
+        if album_path not in failed_albums:
+            journal.finish()
+    if queue.failed:
+        raise Exception('Failed to rip %s' % ', '.join(
+                disc['label'] for disc in queue.failed))
 
 
 # TODO: This is so sad.
@@ -347,13 +944,8 @@ def rip():
     main()
 
 
-def main():
-    # TODO(jleen): Is it worth dispatching to wrip automatically?
-    if platform.CYGWIN:
-        raise Exception('Please use wrip instead')
-    platform.prevent_sleep()
-
-    album_path = config.args[0]
+def read_album(album_path):
+    """Returns the lines of an album's catalog entry, and its playlists."""
     filename = os.path.join(platform.catalog_path, album_path)
     master_name = os.path.split(filename)[1]
     f = open(filename, 'r', encoding='UTF-8')
@@ -361,16 +953,33 @@ def main():
     f.close()
     playlists = make_playlists(master_name, track_list, album_path,
                                config.extension)
+    return track_list, playlists
+
+
+def main():
+    # TODO(jleen): Is it worth dispatching to wrip automatically?
+    if platform.CYGWIN:
+        raise Exception('Please use wrip instead')
+    platform.prevent_sleep()
+
+    if config.drives and config.rip and not config.rename:
+        rip_queue(config.args)
+        return
+
+    album_path = config.args[0]
+    (track_list, playlists) = read_album(album_path)
+    album_dir = os.path.join(platform.music_path, album_path)
+    journal = RipJournal(album_dir)
 
     if not config.rename:
-        assert_first_disc_length(playlists[0]['tracks'])
+        assert_first_disc_length(playlists[0]['tracks'], album_path, journal)
     if config.create_playlists:
-        write_playlists(playlists,
-                        os.path.join(platform.music_path, album_path),
-                        rename=config.rename)
+        # If we're picking up an interrupted rip, the album's already there.
+        write_playlists(playlists, album_dir,
+                        rename=config.rename or journal.resuming)
 
     if config.rename:
         rename_files(playlists[0]['tracks'], album_path,
                      config.extension)
     elif config.rip:
-        rip_and_encode(playlists[0]['tracks'], album_path)
+        rip_and_encode(playlists[0]['tracks'], album_path, journal)
@@ -0,0 +1,219 @@
+"""How a rip went: how fast each track read and encoded, and how hard
+cdparanoia had to work to read it, with a summary of each disc.  It's
+printed as we go, and appended to a log, of JSON lines or, for a .csv file,
+CSV, so that drives and sessions can be compared over time."""
+
+import collections
+import csv
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from discjockey import audiofile
+
+# With -e, cdparanoia reports everything that it does on stderr, one line
+# each, as `##: CODE [NAME] @ POSITION`.  These are the things that it does
+# when a read doesn't come back clean, and has to read again.
+PARANOIA_RETRIES = {'jitter', 'correction', 'scratch', 'scratch repair',
+                    'dropped', 'duped', 'transport error', 'cache error'}
+PARANOIA_SKIP = 'skip'
+PARANOIA_EVENT = re.compile(rb'##: -?\d+ \[([^\]]*)\]')
+
+# The columns of a CSV log.  A JSON log has the same fields.
+FIELDS = ['time', 'session', 'kind', 'drive', 'album', 'disc', 'track',
+          'tracks', 'audio_seconds', 'seconds', 'read_seconds', 'read_speed',
+          'encode_seconds', 'encode_cpu_seconds', 'bytes', 'ratio',
+          'retries', 'skips']
+
+_print_lock = threading.Lock()
+
+
+def say(*lines):
+    """Print lines together, even with other drives printing too."""
+    with _print_lock:
+        for line in lines:
+            print(line)
+
+
+class ParanoiaReader:
+    """Reads the stderr of a cdparanoia run with -e as it rips, counting
+    what it reports, and passing the rest (its progress bar) through to our
+    stderr if `echo`."""
+
+    def __init__(self, stream, echo):
+        self.events = collections.Counter()
+        self._start = time.perf_counter()
+        self._end = None
+        self._thread = threading.Thread(target=self._read,
+                                        args=(stream, echo), daemon=True)
+        self._thread.start()
+
+    def _read(self, stream, echo):
+        pending = b''
+        while True:
+            chunk = stream.read1(4096)
+            if not chunk:
+                break
+            # The progress bar is redrawn with carriage returns.
+            pieces = re.split(rb'(?<=[\r\n])', pending + chunk)
+            pending = pieces.pop()
+            for piece in pieces:
+                match = PARANOIA_EVENT.match(piece)
+                if match:
+                    self.events[match.group(1).decode('ascii')] += 1
+                elif echo:
+                    sys.stderr.buffer.write(piece)
+            if echo:
+                sys.stderr.flush()
+        if echo and pending:
+            sys.stderr.buffer.write(pending)
+            sys.stderr.flush()
+        stream.close()
+        self._end = time.perf_counter()
+
+    def finish(self):
+        """Wait for cdparanoia to finish, and return how the read went."""
+        self._thread.join()
+        return {
+            'read_seconds': self._end - self._start,
+            'retries': sum(n for (event, n) in self.events.items()
+                           if event in PARANOIA_RETRIES),
+            'skips': self.events[PARANOIA_SKIP],
+        }
+
+
+class RipLog:
+    """The log for a session of ripping, or just the printout if `path` is
+    None."""
+
+    def __init__(self, path=None):
+        self.session = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._path = path
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        if not self._path:
+            return
+        record = dict(time=time.time(), session=self.session, **record)
+        with self._lock:
+            if self._path.endswith('.csv'):
+                new = (not os.path.exists(self._path)
+                       or not os.path.getsize(self._path))
+                with open(self._path, 'a', newline='') as f:
+                    writer = csv.DictWriter(f, FIELDS)
+                    if new:
+                        writer.writeheader()
+                    writer.writerow(record)
+            else:
+                with open(self._path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+
+class DiscStats:
+    """Gathers up the tracks of one disc as they finish, and sums the disc up
+    once the drive is done with it and every track it read is encoded."""
+
+    def __init__(self, log, drive, album_path, disc_num, num_discs,
+                 prefix=''):
+        self._log = log
+        self._prefix = prefix
+        self._fields = {'drive': drive, 'album': album_path,
+                        'disc': disc_num}
+        self._label = 'disc %d of %d' % (disc_num, num_discs)
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._records = []
+        self._pending = 0
+        self._reading = True
+
+    def expect(self):
+        """A track is being ripped."""
+        with self._lock:
+            self._pending += 1
+
+    def track(self, fraction, title, output_file, read, encode_seconds,
+              encode_cpu):
+        """A track has been ripped and encoded.  `read` is how the read went,
+        if cdparanoia did it."""
+        size = os.path.getsize(output_file)
+        try:
+            audio_seconds = audiofile.duration(output_file)
+        except Exception:
+            audio_seconds = None
+        record = dict(self._fields, kind='track',
+                      track=os.path.basename(output_file),
+                      audio_seconds=audio_seconds,
+                      encode_seconds=encode_seconds,
+                      encode_cpu_seconds=encode_cpu, bytes=size,
+                      ratio=(size / (audio_seconds
+                                     * audiofile.CD_BYTES_PER_SEC)
+                             if audio_seconds else None))
+        if read:
+            record.update(read)
+            record['read_speed'] = (audio_seconds / read['read_seconds']
+                                    if audio_seconds else None)
+        self._log.write(record)
+
+        parts = []
+        if read and record['read_speed']:
+            parts.append('read at %.1fx, %d retries, %d skips'
+                         % (record['read_speed'], read['retries'],
+                            read['skips']))
+        parts.append('encoded in %.1fs' % encode_seconds)
+        if record['ratio']:
+            parts.append('%.0f%% of the WAV size' % (record['ratio'] * 100))
+        say('%s Done with %s: %s' % (fraction, title, ', '.join(parts)))
+
+        with self._lock:
+            self._records.append(record)
+            self._pending -= 1
+            self._maybe_summarize()
+
+    def done_reading(self):
+        """The drive has read every track that it's going to."""
+        with self._lock:
+            self._reading = False
+            self._maybe_summarize()
+
+    def _maybe_summarize(self):
+        if self._reading or self._pending or not self._records:
+            return
+        records = self._records
+        self._records = []
+
+        def total(field):
+            values = [r[field] for r in records if r.get(field) is not None]
+            return sum(values) if values else None
+
+        audio_seconds = total('audio_seconds')
+        read_seconds = total('read_seconds')
+        summary = dict(self._fields, kind='disc', tracks=len(records),
+                       seconds=time.perf_counter() - self._start,
+                       audio_seconds=audio_seconds,
+                       read_seconds=read_seconds,
+                       read_speed=(audio_seconds / read_seconds
+                                   if audio_seconds and read_seconds
+                                   else None),
+                       encode_seconds=total('encode_seconds'),
+                       encode_cpu_seconds=total('encode_cpu_seconds'),
+                       bytes=total('bytes'),
+                       ratio=(total('bytes') / (audio_seconds
+                                                * audiofile.CD_BYTES_PER_SEC)
+                              if audio_seconds else None),
+                       retries=total('retries'), skips=total('skips'))
+        self._log.write(summary)
+
+        line = '%s--- Finished %s: %d tracks in %s' % (
+                self._prefix, self._label, len(records),
+                audiofile.format_duration(summary['seconds']))
+        if summary['read_speed']:
+            line += ', read at %.1fx with %d retries and %d skips' % (
+                    summary['read_speed'], summary['retries'],
+                    summary['skips'])
+        line += ', %.1f MB' % (summary['bytes'] / 1e6)
+        if summary['ratio']:
+            line += ' (%.0f%%)' % (summary['ratio'] * 100)
+        say(line + ' ---')
@@ -0,0 +1,94 @@
+"""A content-addressed store of transcoded files, kept inside the cache, so
+that audio that turns up in more than one place is only encoded and stored
+once.
+
+Entries are filed by an audio key, made from the audio and the settings that
+it was encoded with, and then by a tags key, since the same audio can carry
+different tags in different places.  Every cache entry that came from the
+store is a hard link to a store entry, so an entry that nothing links to any
+more is garbage."""
+
+import errno
+import hashlib
+import os
+import shutil
+
+STORE_DIRNAME = '.discjockey-store'
+
+
+def is_store_dir(filename):
+    return filename == STORE_DIRNAME
+
+
+def audio_key(fingerprint, settings):
+    return hashlib.sha1(('%s\0%s' % (fingerprint, settings))
+                        .encode('utf-8')).hexdigest()
+
+
+def tags_key(tags):
+    sha1 = hashlib.sha1()
+    for (key, val) in tags:
+        sha1.update(key + b'=' + val + b'\0')
+    return sha1.hexdigest()
+
+
+class Store:
+    """The store in one cache, for outputs with the given extension."""
+
+    def __init__(self, cache_dir, extension):
+        self._root = os.path.join(cache_dir, STORE_DIRNAME)
+        self._extension = extension
+
+    def _dir(self, akey):
+        return os.path.join(self._root, akey[:2], akey)
+
+    def path(self, akey, tkey):
+        return os.path.join(self._dir(akey), tkey + self._extension)
+
+    def any_path(self, akey):
+        """Returns an entry with the given audio, whatever its tags, or None
+        if there isn't one."""
+        try:
+            names = sorted(os.listdir(self._dir(akey)))
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if name.endswith(self._extension):
+                return os.path.join(self._dir(akey), name)
+        return None
+
+    def add(self, path, akey, tkey):
+        """File a finished cache entry in the store, by linking to it."""
+        os.makedirs(self._dir(akey), exist_ok=True)
+        try:
+            os.link(path, self.path(akey, tkey))
+        except FileExistsError:
+            pass
+        except OSError as e:
+            # The store is in the cache, so this only fails if the cache
+            # spans filesystems.  We can live without deduping that entry.
+            if e.errno != errno.EXDEV:
+                raise
+
+    def collect(self):
+        """Remove the entries that no cache entry links to any more.  Returns
+        how many there were."""
+        removed = 0
+        try:
+            buckets = list(os.scandir(self._root))
+        except FileNotFoundError:
+            return 0
+        for bucket in buckets:
+            for key_dir in list(os.scandir(bucket.path)):
+                live = False
+                for entry in list(os.scandir(key_dir.path)):
+                    if entry.stat(follow_symlinks=False).st_nlink > 1:
+                        live = True
+                    else:
+                        os.unlink(entry.path)
+                        removed += 1
+                if not live:
+                    shutil.rmtree(key_dir.path)
+            if not os.listdir(bucket.path):
+                os.rmdir(bucket.path)
+        return removed
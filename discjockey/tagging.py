@@ -0,0 +1,306 @@
+"""Just enough of the Ogg Vorbis and ID3v2 formats to copy a file that we've
+transcoded with a different set of tags, without encoding it again, and of
+FLAC to retag a file without metaflac.
+
+Tags are given as (lowercased key, value) pairs of bytes, the way
+audiofile.parse_vorbis_comment returns them."""
+
+import os
+import shutil
+import struct
+import zlib
+
+# ID3v2 frames for the tags that we carry over into MP3s, the same ones that
+# we hand to lame.
+ID3_FRAMES = {
+    b'title': b'TIT2',
+    b'artist': b'TPE1',
+    b'album': b'TALB',
+    b'tracknumber': b'TRCK',
+    b'genre': b'TCON',
+}
+
+OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+OGG_CONTINUED = 0x01
+
+# The most payload that we put on a page of headers, which is what libogg
+# aims for too.
+OGG_PAGE_TARGET = 4096
+
+FLAC_PADDING = 1
+FLAC_VORBIS_COMMENT = 4
+FLAC_LAST_BLOCK = 0x80
+
+# The padding we leave when we have to rewrite a FLAC file anyway, so that
+# the next retagging fits; the same as flac leaves.
+FLAC_NEW_PADDING = 8192
+
+# For a FLAC file that has no comments to take a vendor string from.
+FLAC_VENDOR = b'discjockey'
+
+_BIT_REVERSED = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def _ogg_crc(data):
+    """Ogg's CRC-32 is the unreflected form of the usual one, with no
+    inversion, which zlib can compute over bit-reversed input."""
+    crc = zlib.crc32(data.translate(_BIT_REVERSED), 0xffffffff) ^ 0xffffffff
+    return int('{:032b}'.format(crc)[::-1], 2)
+
+
+def _ogg_page(flags, granule, serial, sequence, segments, payload):
+    header = OGG_PAGE_HEADER.pack(b'OggS', 0, flags, granule, serial,
+                                  sequence, 0, len(segments))
+    page = bytearray(header + bytes(segments) + payload)
+    struct.pack_into('<I', page, 22, _ogg_crc(bytes(page)))
+    return bytes(page)
+
+
+def _read_ogg_pages(data):
+    """Yields (flags, granule, serial, sequence, segments, payload) for each
+    page in an Ogg stream."""
+    pos = 0
+    while pos < len(data):
+        (magic, _, flags, granule, serial, sequence, _,
+         num_segments) = OGG_PAGE_HEADER.unpack_from(data, pos)
+        if magic != b'OggS':
+            raise Exception('Bad Ogg page at offset %d' % pos)
+        pos += OGG_PAGE_HEADER.size
+        segments = data[pos:pos + num_segments]
+        pos += num_segments
+        payload = data[pos:pos + sum(segments)]
+        pos += sum(segments)
+        yield flags, granule, serial, sequence, segments, payload
+
+
+def _paginate(packets, serial):
+    """Lays header packets out on pages, the first of them starting a fresh
+    page and the last ending one."""
+    pages = []
+    segments = []
+    payload = b''
+    continued = False
+    for packet in packets:
+        lacing = [255] * (len(packet) // 255) + [len(packet) % 255]
+        pos = 0
+        for (i, value) in enumerate(lacing):
+            if len(segments) == 255 or (len(payload) >= OGG_PAGE_TARGET
+                                        and segments):
+                pages.append((OGG_CONTINUED if continued else 0, segments,
+                              payload))
+                segments = []
+                payload = b''
+                continued = i > 0
+            segments.append(value)
+            payload += packet[pos:pos + value]
+            pos += value
+    pages.append((OGG_CONTINUED if continued else 0, segments, payload))
+    return [(flags, 0, serial, 0, segments, payload)
+            for (flags, segments, payload) in pages]
+
+
+def retag_ogg(src_path, dst_path, tags):
+    """Copy an Ogg Vorbis file, replacing its comments.  The audio pages are
+    copied as they are, apart from their sequence numbers."""
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    pages = _read_ogg_pages(data)
+
+    # The identification header is alone on the first page, and the comment
+    # and setup headers fill the pages up to the first audio page.
+    first = next(pages)
+    header_pages = []
+    packets = []
+    packet = b''
+    for page in pages:
+        header_pages.append(page)
+        (_, _, _, _, segments, payload) = page
+        pos = 0
+        for lacing in segments:
+            packet += payload[pos:pos + lacing]
+            pos += lacing
+            if lacing < 255:
+                packets.append(packet)
+                packet = b''
+        if len(packets) >= 2 and not packet:
+            break
+    if len(packets) != 2 or packets[0][:7] != b'\x03vorbis':
+        raise Exception('%s has no Vorbis comment header' % src_path)
+
+    (vendor_len,) = struct.unpack_from('<I', packets[0], 7)
+    vendor = packets[0][11:11 + vendor_len]
+    comment = [b'\x03vorbis', struct.pack('<I', len(vendor)), vendor,
+               struct.pack('<I', len(tags))]
+    for (key, val) in tags:
+        field = key.upper() + b'=' + val
+        comment += [struct.pack('<I', len(field)), field]
+    comment.append(b'\x01')
+    serial = first[2]
+    new_pages = [first] + _paginate([b''.join(comment), packets[1]], serial)
+
+    with open(dst_path, 'wb') as out:
+        for (sequence, page) in enumerate(new_pages):
+            (flags, granule, _, _, segments, payload) = page
+            out.write(_ogg_page(flags, granule, serial, sequence, segments,
+                                payload))
+        shift = len(new_pages) - 1 - len(header_pages)
+        for (flags, granule, page_serial, sequence, segments,
+             payload) in pages:
+            out.write(_ogg_page(flags, granule, page_serial, sequence + shift,
+                                segments, payload))
+
+
+def _syncsafe(size):
+    return bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f,
+                  (size >> 7) & 0x7f, size & 0x7f])
+
+
+def _id3_text_frame(frame_id, value):
+    try:
+        text = b'\x00' + value.decode('utf-8').encode('latin-1')
+    except UnicodeError:
+        text = b'\x01' + value.decode('utf-8', 'replace').encode('utf-16')
+    return frame_id + struct.pack('>I', len(text)) + b'\x00\x00' + text
+
+
+def _strip_id3(data):
+    """Returns the MPEG audio in an MP3, without its ID3 tags."""
+    start = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        size = 0
+        for b in data[6:10]:
+            size = (size << 7) | (b & 0x7f)
+        # A footer is as big as the header.
+        start = 10 + size + (10 if data[5] & 0x10 else 0)
+    end = len(data)
+    if end - start >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+    return data[start:end]
+
+
+def retag_mp3(src_path, dst_path, tags):
+    """Copy an MP3, replacing its ID3 tags with an ID3v2.3 tag.  The LAME
+    header frame, if there is one, comes along with the audio."""
+    with open(src_path, 'rb') as f:
+        audio = _strip_id3(f.read())
+    frames = b''.join(_id3_text_frame(ID3_FRAMES[key], val)
+                      for (key, val) in tags if key in ID3_FRAMES)
+    with open(dst_path, 'wb') as out:
+        if frames:
+            out.write(b'ID3\x03\x00\x00' + _syncsafe(len(frames)) + frames)
+        out.write(audio)
+
+
+def retag(src_path, dst_path, tags):
+    if src_path.lower().endswith('.mp3'):
+        retag_mp3(src_path, dst_path, tags)
+    elif src_path.lower().endswith('.ogg'):
+        retag_ogg(src_path, dst_path, tags)
+    else:
+        raise Exception("Don't know how to retag %s" % src_path)
+
+
+def _skip_id3v2(f):
+    """Some taggers stick an ID3v2 tag in front of a FLAC file.  Returns
+    where the FLAC stream starts, leaving the file there."""
+    head = f.read(10)
+    start = 0
+    if head[:3] == b'ID3' and len(head) == 10:
+        size = 0
+        for b in head[6:10]:
+            size = (size << 7) | (b & 0x7f)
+        start = 10 + size + (10 if head[5] & 0x10 else 0)
+    f.seek(start)
+    return start
+
+
+def _read_flac_metadata(f):
+    """Returns the metadata blocks of a FLAC file as (type, data) pairs,
+    leaving out padding, the offset of the FLAC stream, after any ID3v2 tag,
+    and the offset of the audio."""
+    flac_start = _skip_id3v2(f)
+    if f.read(4) != b'fLaC':
+        raise Exception('%s is not a FLAC file' % f.name)
+    blocks = []
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            raise Exception('%s has truncated metadata' % f.name)
+        last = header[0] & FLAC_LAST_BLOCK
+        block_type = header[0] & ~FLAC_LAST_BLOCK
+        size = int.from_bytes(header[1:], 'big')
+        if block_type == FLAC_PADDING:
+            f.seek(size, os.SEEK_CUR)
+        else:
+            blocks.append((block_type, f.read(size)))
+    return blocks, flac_start, f.tell()
+
+
+def _flac_comment_block(vendor, tags):
+    fields = [key.upper() + b'=' + val for (key, val) in tags]
+    return b''.join([struct.pack('<I', len(vendor)), vendor,
+                     struct.pack('<I', len(fields))]
+                    + [struct.pack('<I', len(field)) + field
+                       for field in fields])
+
+
+def _flac_metadata(blocks, padding):
+    """Lays out metadata blocks, followed by a padding block of the given
+    size, or none if it's None."""
+    if padding is not None:
+        blocks = blocks + [(FLAC_PADDING, bytes(padding))]
+    out = []
+    for (i, (block_type, data)) in enumerate(blocks):
+        if i == len(blocks) - 1:
+            block_type |= FLAC_LAST_BLOCK
+        out += [bytes([block_type]), len(data).to_bytes(3, 'big'), data]
+    return b''.join(out)
+
+
+def retag_flac(path, tags):
+    """Replace the Vorbis comments of a FLAC file.  If the new metadata fits
+    where the old metadata and its padding were, it's written over them and
+    the audio is left alone; otherwise the file is rewritten, with fresh
+    padding.  An ID3v2 tag in front of the FLAC stream is kept, as metaflac
+    keeps it.  Returns True if the file was retagged in place."""
+    with open(path, 'r+b') as f:
+        (blocks, flac_start, audio_start) = _read_flac_metadata(f)
+        vendor = FLAC_VENDOR
+        for (block_type, data) in blocks:
+            if block_type == FLAC_VORBIS_COMMENT:
+                (vendor_len,) = struct.unpack_from('<I', data)
+                vendor = data[4:4 + vendor_len]
+        comment = (FLAC_VORBIS_COMMENT, _flac_comment_block(vendor, tags))
+        if any(block_type == FLAC_VORBIS_COMMENT
+               for (block_type, _) in blocks):
+            blocks = [comment if block_type == FLAC_VORBIS_COMMENT
+                      else (block_type, data)
+                      for (block_type, data) in blocks]
+        else:
+            # STREAMINFO has to stay first.
+            blocks = blocks[:1] + [comment] + blocks[1:]
+
+        space = audio_start - flac_start - 4
+        used = sum(4 + len(data) for (_, data) in blocks)
+        if used == space or used + 4 <= space:
+            padding = None if used == space else space - used - 4
+            f.seek(flac_start + 4)
+            f.write(_flac_metadata(blocks, padding))
+            return True
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as out:
+                f.seek(0)
+                out.write(f.read(flac_start))
+                out.write(b'fLaC' + _flac_metadata(blocks, FLAC_NEW_PADDING))
+                f.seek(audio_start)
+                shutil.copyfileobj(f, out, 1 << 20)
+            shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+        except (Exception, KeyboardInterrupt):
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return False
@@ -1,24 +1,684 @@
 # Copyright (c) 2012-2016 John Leen
 
 import argparse
+import bisect
+import concurrent.futures
+import copy
+import errno
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import math
 import os
-import re
 import shutil
+import stat
 import subprocess
 import sys
+import threading
+import time
+
+from discjockey import audiofile
+from discjockey import manifest
+from discjockey import metrics
+from discjockey import store
+from discjockey import tagging
 
 LOSSLESS_FORMATS = ['.flac', '.wav']
 BORING_FORMATS = ['.mp3', '.m4a', '.wma', '.mid']
 
+# The Ogg quality for lossless sources, and for Ogg sources, which we
+# encode again, unless --ogg_quality or an ogg:QUALITY:DIR profile says
+# otherwise.
+OGG_LOSSLESS_QUALITY = 6
+OGG_LOSSY_QUALITY = 5
+
+# How often to redraw the progress line on a terminal, and how often to print
+# one otherwise.
+PROGRESS_TTY_INTERVAL = 0.5
+PROGRESS_INTERVAL = 30.0
+
+# In --watch mode, wait for the music tree to be quiet for this many seconds
+# before acting on a burst of changes, but don't wait more than this long.
+WATCH_SETTLE = 2.0
+WATCH_MAX_DELAY = 30.0
+
+# With --max_load, how often a job that's waiting for the load to come down
+# looks again.
+LOAD_POLL_INTERVAL = 5.0
+
+
+def lpt_makespan(costs, workers, busy=()):
+    """How long it takes to run jobs of the given costs on the given number of
+    workers, if each job goes to whichever worker is free first, longest job
+    first.  `busy` is how long each of the workers that are already busy has
+    left to go."""
+    loads = list(busy) + [0.0] * max(1 - len(busy), workers - len(busy))
+    heapq.heapify(loads)
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(loads, heapq.heappop(loads) + cost)
+    return max(loads)
+
+
+# The ioctl that makes a file share another's extents, on btrfs, XFS and the
+# like.
+FICLONE = 0x40049409
+
+# What the kernel says when a filesystem can't do a fancy copy.
+COPY_UNSUPPORTED = [errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY,
+                    errno.ENOSYS]
+
+
+def clone_file(src_path, dst_path):
+    """Copy a file as cheaply as the filesystems allow: a reflink if they
+    can share extents, otherwise a copy in the kernel, otherwise the usual
+    way.  Returns which of 'reflink', 'copy_file_range' or 'copy' it used."""
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED:
+                raise
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                    pass
+                return 'copy_file_range'
+            except OSError as e:
+                if e.errno not in COPY_UNSUPPORTED:
+                    raise
+    # This starts over from scratch, and uses sendfile where it can.
+    shutil.copyfile(src_path, dst_path)
+    return 'copy'
+
+
+def walk_for_sigil(path, sigil):
+    """Return whether the given directory or a descendant contains a sigil
+    file, by walking it.  This is how pruning found out before the sigil
+    index, and what --nosigil_index does, for comparison."""
+    for (_, _, files) in os.walk(path):
+        if sigil in files:
+            return True
+    return False
+
+
+class Progress:
+    """How far through a batch of transcodes we are, how fast it's going in
+    multiples of realtime, and when it'll be done.  On a terminal this is a
+    status line, redrawn in place below everything else we print; otherwise
+    it's a line every PROGRESS_INTERVAL seconds.
+
+    Jobs must start in the order that they're given to start(), longest
+    first, which is how the worker pool takes them."""
+
+    def __init__(self, out, workers):
+        self._out = out
+        self._tty = out.isatty()
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._active = False
+        self._drawn = False
+        self._ticker = None
+
+    def start(self, jobs):
+        """Begin a batch of (audio seconds, source bytes) jobs."""
+        with self._lock:
+            self._costs = [cost for (cost, _) in jobs]
+            self._total_bytes = sum(size for (_, size) in jobs)
+            self._next = 0
+            self._running = {}
+            self._done_files = 0
+            self._done_bytes = 0
+            self._done_audio = 0.0
+            self._job_time = 0.0
+            self._start = time.perf_counter()
+            self._last_line = self._start
+            self._active = True
+        self._stopping = threading.Event()
+        self._ticker = threading.Thread(target=self._tick, daemon=True)
+        self._ticker.start()
+
+    def job_started(self):
+        """Returns a token to hand to job_finished."""
+        with self._lock:
+            token = self._next
+            self._next += 1
+            self._running[token] = time.perf_counter()
+            return token
+
+    def job_finished(self, token, size, elapsed):
+        with self._lock:
+            del self._running[token]
+            self._done_files += 1
+            self._done_bytes += size
+            self._done_audio += self._costs[token]
+            self._job_time += elapsed
+            if self._tty:
+                self._draw()
+
+    def stop(self):
+        if self._ticker is None:
+            return
+        self._stopping.set()
+        self._ticker.join()
+        self._ticker = None
+        with self._lock:
+            self._clear()
+            self._active = False
+
+    def print(self, message):
+        """Print a line above the status line."""
+        with self._lock:
+            self._clear()
+            self._out.write(message + '\n')
+            if self._active and self._tty:
+                self._draw()
+            self._out.flush()
+
+    def _tick(self):
+        interval = PROGRESS_TTY_INTERVAL if self._tty else PROGRESS_INTERVAL
+        while not self._stopping.wait(interval):
+            with self._lock:
+                if self._tty:
+                    self._draw()
+                else:
+                    self._out.write(self._status() + '\n')
+                    self._out.flush()
+
+    def _eta(self, now):
+        # Until a job with a known length has finished, we can't tell.
+        if not self._job_time or not self._done_audio:
+            return None
+        # Seconds of audio per second of a single job.
+        speed = self._done_audio / self._job_time
+        busy = [max(0.0, self._costs[token] / speed - (now - started))
+                for (token, started) in self._running.items()]
+        queued = self._costs[self._next:]
+        if len(queued) > 4 * self._workers:
+            # Until the last few jobs, the workers stay evenly loaded.
+            return (sum(busy) + sum(queued) / speed) / self._workers
+        return lpt_makespan([cost / speed for cost in queued],
+                            self._workers, busy)
+
+    def _status(self):
+        now = time.perf_counter()
+        elapsed = now - self._start
+        eta = self._eta(now)
+        return ('%d/%d files, %.1f/%.1f MB, %s/%s of audio, %.0fx realtime, '
+                'ETA %s'
+                % (self._done_files, len(self._costs),
+                   self._done_bytes / 1e6, self._total_bytes / 1e6,
+                   audiofile.format_duration(self._done_audio),
+                   audiofile.format_duration(sum(self._costs)),
+                   self._done_audio / max(elapsed, 1e-9),
+                   '--' if eta is None else audiofile.format_duration(eta)))
+
+    def _draw(self):
+        width = shutil.get_terminal_size().columns
+        self._out.write('\r\x1b[K' + self._status()[:width - 1])
+        self._out.flush()
+        self._drawn = True
+
+    def _clear(self):
+        if self._drawn:
+            self._out.write('\r\x1b[K')
+            self._drawn = False
+
+
+class ReferentIndex:
+    """The cache paths of m3u referents, grouped by directory.  Each directory
+    name is stored once however many referents it holds, and the sorted list
+    of directories answers "is there a referent anywhere under here?" with a
+    binary search."""
+
+    def __init__(self):
+        self._by_dir = {}
+        self._sorted_dirs = None
+
+    def clear(self):
+        self._by_dir.clear()
+        self._sorted_dirs = None
+
+    def update(self, rel_paths):
+        for rel_path in rel_paths:
+            (rel_dir, filename) = os.path.split(rel_path)
+            filenames = self._by_dir.get(rel_dir)
+            if filenames is None:
+                filenames = self._by_dir[rel_dir] = set()
+                self._sorted_dirs = None
+            filenames.add(filename)
+
+    def contains(self, rel_dir, filename):
+        filenames = self._by_dir.get(rel_dir)
+        return filenames is not None and filename in filenames
+
+    def contains_under(self, rel_dir):
+        """Whether any referent lives in the given directory or below it."""
+        if rel_dir in self._by_dir:
+            return True
+        if self._sorted_dirs is None:
+            self._sorted_dirs = sorted(self._by_dir)
+        # Everything under rel_dir sorts together, right after the prefix.
+        prefix = os.path.join(rel_dir, '')
+        i = bisect.bisect_left(self._sorted_dirs, prefix)
+        return (i < len(self._sorted_dirs)
+                and self._sorted_dirs[i].startswith(prefix))
+
+
+def estimate_cost(in_path):
+    """How long a transcode will take, in seconds of audio."""
+    try:
+        return audiofile.duration(in_path)
+    except Exception:
+        # Guess, from how long it would be as a WAV.
+        return os.path.getsize(in_path) / audiofile.CD_BYTES_PER_SEC
+
+
+class Source:
+    """A file to be transcoded, as the cache for each output profile sees it.
+    `decode_cmd` writes the audio to stdout as raw little-endian PCM, in the
+    format that `header()` describes; a source with no `decoder` can only be
+    encoded by tools that read the file themselves."""
+
+    def __init__(self, path, label, size, decoder=None, decode_cmd=None,
+                 header=None):
+        self.path = path
+        self.label = label
+        self.size = size
+        self.decoder = decoder
+        self.decode_cmd = decode_cmd
+        self.header = header
+
+
+class Target:
+    """One output to be made from a Source.  `raw_cmd(header_data)` returns
+    the command that encodes raw PCM from stdin, and `file_cmd`, if there is
+    one, the command that encodes straight from the source file.  `done(start,
+    cpu, bytes_read)` is called once the output is complete, and `failed()` if
+    it has to be abandoned."""
+
+    def __init__(self, out_path, tool, raw_cmd, file_cmd, done, failed):
+        self.out_path = out_path
+        self.tool = tool
+        self.raw_cmd = raw_cmd
+        self.file_cmd = file_cmd
+        self.done = done
+        self.failed = failed
+
+
+class JobRunner:
+    """Runs the transcodes that the caches for each output profile ask for,
+    on a pool of worker threads if there's more than one job at once.
+
+    Targets are merged by source, so that a source that several caches want
+    is decoded once, and the PCM fanned out to all of their encoders at
+    once.
+
+    Filesystem work (links, copies, playlists and pruning) runs on a separate
+    pool of io_jobs threads, so that it neither waits behind the encoders nor
+    takes their CPUs.  If max_load is set, no more transcodes run at once than
+    keep the load average under it, counting our own processes out of it, and
+    nice and ionice_cmd lower the priority of the processes that we start."""
+
+    def __init__(self, jobs, run_metrics, io_jobs=0, max_load=None,
+                 nice=None, ionice_cmd=None):
+        self.jobs = jobs
+        self.metrics = run_metrics
+        self.progress = Progress(sys.stdout, jobs)
+        self.pool = None
+        if jobs > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.io_pool = None
+        if io_jobs > 0:
+            self.io_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=io_jobs, thread_name_prefix='io')
+        self._io_futures = []
+        self._io_outputs = set()
+        self._max_load = max_load
+        self._nice = nice
+        self._ionice_cmd = ionice_cmd or []
+        self._slots = threading.Condition()
+        self._active_jobs = 0
+        self._job_limit = jobs
+        # Encoder processes that are currently running, so that we can kill
+        # them all if the run is aborted while several jobs are in flight.
+        self._procs_lock = threading.Lock()
+        self._running_procs = set()
+        self._aborting = threading.Event()
+        # Transcodes waiting to run, by source path: (source, targets).
+        self._pending = {}
+        self._pending_outputs = set()
+
+    def announce(self, message):
+        self.progress.print(message)
+
+    def spawn(self, cmd, **kwargs):
+        with self._procs_lock:
+            if self._aborting.is_set():
+                raise Exception('Transcode aborted')
+            proc = subprocess.Popen(self._ionice_cmd + cmd, **kwargs)
+            self._running_procs.add(proc)
+        if self._nice:
+            try:
+                os.setpriority(os.PRIO_PROCESS, proc.pid, self._nice)
+            except ProcessLookupError:
+                # It's already finished.
+                pass
+        self.metrics.spawned()
+        return proc
+
+    def wait_child(self, proc, tool):
+        """Wait for a child to finish, charging its CPU time to a tool.
+        Returns the CPU time."""
+        (_, status, rusage) = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        cpu = rusage.ru_utime + rusage.ru_stime
+        self.metrics.add_cpu(tool, cpu)
+        return cpu
+
+    def reap(self, *procs):
+        with self._procs_lock:
+            for proc in procs:
+                if proc is not None:
+                    self._running_procs.discard(proc)
+                    if proc.poll() is None:
+                        proc.kill()
+                        proc.wait()
+
+    def is_pending(self, out_path):
+        return (out_path in self._pending_outputs
+                or out_path in self._io_outputs)
+
+    def io(self, out_path, fn, *args, stage=None):
+        """Do some filesystem work that makes or removes out_path, on the I/O
+        pool if there is one.  Nothing else may touch out_path until
+        io_wait.  Work done inline counts towards whatever stage the caller
+        is timing; on the pool, it's timed as `stage`, if given."""
+        if self.io_pool is None:
+            fn(*args)
+            return
+
+        def work():
+            if stage is None:
+                fn(*args)
+            else:
+                with self.metrics.stage(stage):
+                    fn(*args)
+
+        self._io_outputs.add(out_path)
+        self._io_futures.append(self.io_pool.submit(work))
+
+    def io_wait(self):
+        """Wait for the filesystem work to finish, raising the first error
+        that it ran into."""
+        futures = self._io_futures
+        self._io_futures = []
+        concurrent.futures.wait(futures)
+        self._io_outputs.clear()
+        for future in futures:
+            future.result()
+
+    def schedule(self, source, target):
+        job = self._pending.get(source.path)
+        if job is None:
+            self._pending[source.path] = (source, [target])
+        else:
+            job[1].append(target)
+        self._pending_outputs.add(target.out_path)
+
+    def run(self):
+        """Run the queued transcodes, longest first, since that keeps one long
+        track that starts last from holding up the end of the run."""
+        jobs = sorted(((estimate_cost(source.path), source.size, source,
+                        targets)
+                       for (source, targets) in self._pending.values()),
+                      key=lambda j: j[0], reverse=True)
+        self._pending.clear()
+        self._pending_outputs.clear()
+        if not jobs:
+            self.io_wait()
+            return
+        timings = []
+
+        def timed(cost, size, source, targets):
+            self._acquire_slot()
+            try:
+                token = self.progress.job_started()
+                start = time.perf_counter()
+                self._transcode(source, targets)
+                elapsed = time.perf_counter() - start
+                self.progress.job_finished(token, size, elapsed)
+                timings.append((cost, elapsed))
+            finally:
+                self._release_slot()
+
+        start = time.perf_counter()
+        self.progress.start([(cost, size) for (cost, size, _, _) in jobs])
+        try:
+            if self.pool is None:
+                for job in jobs:
+                    timed(*job)
+            else:
+                futures = [self.pool.submit(timed, *job) for job in jobs]
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        future.result()
+                except (Exception, KeyboardInterrupt):
+                    # Don't leave jobs running behind our back, in case
+                    # there's another batch coming, and don't start the
+                    # ones that are still queued.
+                    self.abort()
+                    for f in futures:
+                        f.cancel()
+                    concurrent.futures.wait(futures)
+                    raise
+        finally:
+            self.progress.stop()
+        self.io_wait()
+        actual = time.perf_counter() - start
+        self.metrics.add_time('transcode', actual)
+
+        # Predict how long an ideal run of these jobs would have taken at the
+        # speed that the encoders actually managed.
+        audio = sum(cost for (cost, _) in timings)
+        # When we couldn't tell how long any of the audio was, there's no
+        # speed to predict with.
+        speed = audio / max(sum(t for (_, t) in timings), 1e-9)
+        if speed:
+            predicted = '%.1fs' % (lpt_makespan(
+                    [c for (c, _, _, _) in jobs], self.jobs) / speed)
+        else:
+            predicted = '--'
+        outputs = sum(len(targets) for (_, _, _, targets) in jobs)
+        self.announce('Transcoded %d files to %d outputs (%.0fs of audio) at '
+                      '%.1fx realtime per job; predicted makespan %s, '
+                      'actual %.1fs'
+                      % (len(jobs), outputs, audio, speed, predicted, actual))
+
+    def abort(self):
+        """Kill any running encoders.  Each job then cleans up its own partial
+        output as it fails."""
+        self._aborting.set()
+        with self._procs_lock:
+            for proc in self._running_procs:
+                proc.terminate()
+
+    def reset(self):
+        """Forget the queued transcodes, and any abort, so that another batch
+        can start afresh."""
+        self._pending.clear()
+        self._pending_outputs.clear()
+        concurrent.futures.wait(self._io_futures)
+        self._io_futures = []
+        self._io_outputs.clear()
+        self._aborting.clear()
+
+    def close(self):
+        if self.pool is not None:
+            # Wait for the killed jobs to clean up after themselves.
+            self.pool.shutdown(wait=True, cancel_futures=True)
+        if self.io_pool is not None:
+            self.io_pool.shutdown(wait=True, cancel_futures=True)
+
+    def _acquire_slot(self):
+        with self._slots:
+            while self._active_jobs >= self._update_limit():
+                self._slots.wait(LOAD_POLL_INTERVAL)
+            self._active_jobs += 1
+
+    def _release_slot(self):
+        with self._slots:
+            self._active_jobs -= 1
+            self._slots.notify()
+
+    def _update_limit(self):
+        """How many transcodes may run at once, given the load that everyone
+        else is putting on the machine."""
+        if self._max_load is None or self._aborting.is_set():
+            return self.jobs
+        with self._procs_lock:
+            ours = len(self._running_procs)
+        others = max(0.0, os.getloadavg()[0] - ours)
+        limit = max(1, min(self.jobs, int(self._max_load - others)))
+        if limit != self._job_limit:
+            logging.info('Load average is %.1f; running %d jobs at once'
+                         % (others + ours, limit))
+            self._job_limit = limit
+        return limit
+
+    def _transcode(self, source, targets):
+        if self._aborting.is_set():
+            # A job that got going before it could be cancelled.
+            raise Exception('Transcode aborted')
+        self.announce('Transcoding %s' % source.label)
+        if source.decoder is None or (len(targets) == 1
+                                      and targets[0].file_cmd):
+            for target in targets:
+                self._encode_file(source, target)
+        else:
+            self._encode_pcm(source, targets)
+
+    def _encode_file(self, source, target):
+        start = time.perf_counter()
+        encode_proc = None
+        try:
+            with open(os.devnull, 'w') as dev_null:
+                encode_proc = self.spawn(target.file_cmd, stdout=dev_null,
+                                         stderr=dev_null)
+                cpu = {target.tool: self.wait_child(encode_proc, target.tool)}
+            if encode_proc.returncode != 0:
+                raise Exception('Abnormal %s termination' % target.tool)
+            target.done(start, cpu, source.size)
+        except (Exception, KeyboardInterrupt):
+            # Remove the incomplete output if we crash during transcoding.
+            self.reap(encode_proc)
+            target.failed()
+            raise
+        finally:
+            self.reap(encode_proc)
 
-def transcode():
+    def _encode_pcm(self, source, targets):
+        start = time.perf_counter()
+        decode_proc = None
+        encode_procs = []
+        try:
+            header_data = source.header()
+            logging.debug('%s has channels=%s bitwidth=%s frequency=%s' %
+                          (source.path, header_data['channels'],
+                           header_data['bitwidth'], header_data['frequency']))
+            with open(os.devnull, 'w') as dev_null:
+                decode_proc = self.spawn(source.decode_cmd,
+                                         stdout=subprocess.PIPE,
+                                         stderr=dev_null)
+                if len(targets) == 1:
+                    encode_procs.append(self.spawn(
+                            targets[0].raw_cmd(header_data),
+                            stdin=decode_proc.stdout, stdout=dev_null,
+                            stderr=dev_null))
+                else:
+                    for target in targets:
+                        encode_procs.append(self.spawn(
+                                target.raw_cmd(header_data),
+                                stdin=subprocess.PIPE, stdout=dev_null,
+                                stderr=dev_null))
+                    fan_out(decode_proc.stdout,
+                            [proc.stdin for proc in encode_procs])
+                decode_proc.stdout.close()
+                cpu = [self.wait_child(proc, target.tool)
+                       for (proc, target) in zip(encode_procs, targets)]
+                decode_cpu = self.wait_child(decode_proc, source.decoder)
+            for (proc, target) in zip(encode_procs, targets):
+                if proc.returncode != 0:
+                    raise Exception('Abnormal %s termination' % target.tool)
+            if decode_proc.returncode != 0:
+                raise Exception('Abnormal %s termination' % source.decoder)
+            # The decode, and the read of the source, were shared by all of
+            # the targets.
+            for (i, target) in enumerate(targets):
+                target.done(start, {target.tool: cpu[i],
+                                    source.decoder: decode_cpu / len(targets)},
+                            source.size if i == 0 else 0)
+        except (Exception, KeyboardInterrupt):
+            self.reap(decode_proc, *encode_procs)
+            for target in targets:
+                target.failed()
+            raise
+        finally:
+            self.reap(decode_proc, *encode_procs)
+
+
+# How much PCM to hand to the encoders at a time when fanning out.
+FAN_OUT_CHUNK = 1 << 16
+
+
+def fan_out(pcm, sinks):
+    """Copy a decoder's output to several encoders.  If one of them dies, we
+    stop; the caller will see that from its exit status."""
+    try:
+        while True:
+            data = pcm.read1(FAN_OUT_CHUNK)
+            if not data:
+                break
+            for sink in sinks:
+                sink.write(data)
+    except BrokenPipeError:
+        pass
+    for sink in sinks:
+        try:
+            sink.close()
+        except BrokenPipeError:
+            pass
+
+
+def parse_profile(args, spec):
+    """Returns a copy of args for an output profile given as 'mp3:DIR',
+    'ogg:DIR', 'ogg:QUALITY:DIR' or 'mirror:DIR'."""
+    (kind, _, cache) = spec.partition(':')
+    profile = copy.copy(args)
+    profile.mp3 = kind == 'mp3'
+    profile.mirror = kind == 'mirror'
+    if kind == 'ogg':
+        (quality, sep, rest) = cache.partition(':')
+        if sep and quality.lstrip('-').isdigit():
+            profile.ogg_quality = int(quality)
+            cache = rest
+    elif kind not in ['mp3', 'mirror']:
+        raise Exception('Unknown kind of profile %s' % spec)
+    if not cache:
+        raise Exception('Profile %s has no cache directory' % spec)
+    profile.cache = cache
+    return profile
+
+
+def transcode(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--music', metavar='DIR', action='append')
     parser.add_argument('--cache', metavar='DIR')
     parser.add_argument('--mp3', action='store_true')
-    parser.add_argument('--ogg_quality', type=int, default=5)
+    parser.add_argument('--ogg_quality', type=int)
     parser.add_argument('--mirror', action='store_true')
     parser.add_argument('--ogg_bin', metavar='PATH', default='/usr/bin/oggenc')
     parser.add_argument('--oggdec_bin', metavar='PATH',
@@ -35,8 +695,28 @@ def transcode():
     parser.add_argument('--keep_sigil', metavar='FILENAME', action='append')
     parser.add_argument('--sigil', metavar='FILENAME')
     parser.add_argument('--skip_dir', metavar='DIR', action='append')
-
-    args = parser.parse_args()
+    parser.add_argument('--nosigil_index', dest='sigil_index',
+                        action='store_false')
+    parser.add_argument('--nomanifest', dest='manifest', action='store_false')
+    parser.add_argument('--plan', nargs='?', const='text',
+                        choices=['text', 'json'])
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--watch', action='store_true')
+    parser.add_argument('--metrics', metavar='FILE')
+    parser.add_argument('--metrics_prometheus', metavar='FILE')
+    parser.add_argument('--profile', metavar='KIND:DIR', action='append')
+    parser.add_argument('--io_jobs', metavar='N', type=int, default=4)
+    parser.add_argument('--max_load', metavar='LOAD', type=float)
+    parser.add_argument('--cpu_share', metavar='FRACTION', type=float)
+    parser.add_argument('--nice', metavar='N', type=int)
+    parser.add_argument('--ionice', choices=['idle', 'best-effort'])
+    parser.add_argument('--ionice_bin', metavar='PATH',
+                        default='/usr/bin/ionice')
+    parser.add_argument('--dedupe', action='store_true')
+    parser.add_argument('--signatures', action='store_true')
+
+    args = parser.parse_args(argv)
 
     if args.verbose and args.verbose >= 2:
         log_level = logging.DEBUG
@@ -46,6 +726,82 @@ def transcode():
         log_level = logging.WARNING
     logging.basicConfig(level=log_level, format='%(message)s')
 
+    if args.watch and args.plan:
+        raise Exception("Can't have both --watch and --plan")
+    if args.plan:
+        # Plans are cheap, so there's no point in farming them out.
+        args.jobs = 1
+        args.io_jobs = 0
+    if args.signatures and not args.manifest:
+        raise Exception("Can't have --signatures without the manifest")
+    if args.max_load is not None and args.cpu_share is not None:
+        raise Exception("Can't have both --max_load and --cpu_share")
+    if args.cpu_share is not None:
+        args.max_load = args.cpu_share * (os.cpu_count() or 1)
+    ionice_cmd = None
+    if args.ionice == 'idle':
+        ionice_cmd = [args.ionice_bin, '-c', '3']
+    elif args.ionice == 'best-effort':
+        ionice_cmd = [args.ionice_bin, '-c', '2', '-n', '7']
+
+    # Each output profile is a cache with its own format.  --mp3, --mirror and
+    # --ogg_quality describe the one in --cache.
+    profiles = []
+    if args.cache:
+        profiles.append(copy.copy(args))
+    for spec in args.profile or []:
+        profiles.append(parse_profile(args, spec))
+    if not profiles:
+        raise Exception('Need a --cache or a --profile')
+    caches = [os.path.realpath(profile.cache) for profile in profiles]
+    if len(set(caches)) != len(caches):
+        raise Exception("Can't have two profiles with the same cache")
+    if len(profiles) > 1 and args.watch:
+        raise Exception("Can't --watch more than one profile")
+    if len(profiles) > 1 and args.plan == 'json':
+        raise Exception("Can't make a JSON plan for more than one profile")
+
+    run_metrics = metrics.Metrics()
+
+    def write_metrics(ok):
+        if args.metrics:
+            run_metrics.write_json(args.metrics, ok)
+        if args.metrics_prometheus:
+            run_metrics.write_prometheus(args.metrics_prometheus, ok)
+
+    runner = JobRunner(args.jobs, run_metrics, io_jobs=args.io_jobs,
+                       max_load=args.max_load, nice=args.nice,
+                       ionice_cmd=ionice_cmd)
+    syncs = [sync_cache(profile, runner, write_metrics)
+             for profile in profiles]
+    ok = False
+    try:
+        # Each cache schedules its transcodes, and then they all run together,
+        # so that sources that more than one cache wants are decoded once.
+        for sync in syncs:
+            next(sync)
+        runner.run()
+        ok = True
+        for (profile, sync) in zip(profiles, syncs):
+            if args.plan and len(profiles) > 1:
+                print('%s:' % profile.cache)
+            next(sync, None)
+    except (Exception, KeyboardInterrupt):
+        runner.abort()
+        raise
+    finally:
+        runner.close()
+        for sync in syncs:
+            sync.close()
+        if not args.watch:
+            write_metrics(ok)
+
+
+def sync_cache(args, runner, write_metrics):
+    """Bring the cache for one output profile up to date.  This is a
+    generator: the first step schedules the transcodes that the cache needs
+    with the runner, and the second, once they've run, finishes off.  In
+    --watch mode, the second step never ends."""
     if args.mp3:
         if args.mirror:
             raise Exception("Can't have both --mirror and --mp3")
@@ -64,6 +820,8 @@ def transcode():
     music_formats = okay_formats + transcode_formats
     link_extns = okay_formats
 
+    run_metrics = runner.metrics
+
     def cache_path(*pathcomps):
         return os.path.join(args.cache, *pathcomps)
 
@@ -76,27 +834,276 @@ def transcode():
     def zeroes(num):
         return '0' * int(1 + math.floor(math.log10(num)))
 
+    # Cache directories that we know exist, so we only check each one once.
+    made_dirs = set()
+
     def ensure_dir(dirname):
+        if args.plan or dirname in made_dirs:
+            return
         if not os.path.isdir(dirname):
-            os.makedirs(dirname)
+            os.makedirs(dirname, exist_ok=True)
+        made_dirs.add(dirname)
 
-    def remove_spurious_file(path):
-        logging.info('Removing spurious file %s' % path)
-        os.unlink(path)
+    # Listings of the cache directories that the walk is working on, taken
+    # with os.scandir, so that we can tell what's in the cache from the
+    # directory entries without a stat per file.  Once we change a name in the
+    # cache its entry goes stale (None), and we ask the filesystem instead.
+    cache_listings = {}
 
-    def remove_spurious_dir(path):
-        logging.info('Removing spurious directory %s' % path)
-        shutil.rmtree(path)
+    def list_cache_dir(rel_dir):
+        try:
+            with os.scandir(cache_path(rel_dir)) as it:
+                listing = {entry.name: entry for entry in it}
+        except FileNotFoundError:
+            return {}
+        made_dirs.add(cache_path(rel_dir))
+        return listing
+
+    def cache_changed(rel_dir, filename):
+        listing = cache_listings.get(rel_dir)
+        if listing is not None:
+            listing[filename] = None
+
+    def cache_kind(rel_dir, filename):
+        """Returns what's at a path in the cache without following symlinks:
+        'file', 'dir', 'link', 'other', or None if there's nothing there."""
+        listing = cache_listings.get(rel_dir)
+        if listing is not None and filename not in listing:
+            return None
+        entry = listing[filename] if listing is not None else None
+        if entry is not None:
+            if entry.is_symlink():
+                return 'link'
+            elif entry.is_dir(follow_symlinks=False):
+                return 'dir'
+            elif entry.is_file(follow_symlinks=False):
+                return 'file'
+            else:
+                return 'other'
+        try:
+            mode = os.lstat(cache_path(rel_dir, filename)).st_mode
+        except FileNotFoundError:
+            return None
+        if stat.S_ISLNK(mode):
+            return 'link'
+        elif stat.S_ISDIR(mode):
+            return 'dir'
+        elif stat.S_ISREG(mode):
+            return 'file'
+        else:
+            return 'other'
+
+    def cache_stat(rel_dir, filename):
+        listing = cache_listings.get(rel_dir)
+        if listing is not None and listing.get(filename) is not None:
+            return listing[filename].stat(follow_symlinks=False)
+        return os.lstat(cache_path(rel_dir, filename))
+
+    # DirEntries for the files in the source directory that the walk is on.
+    source_entries = {}
+
+    def source_stat(path):
+        entry = source_entries.get(path)
+        if entry is not None:
+            return entry.stat()
+        return os.stat(path)
+
+    # What we would have done, if we're only making a plan, and the cache
+    # paths that it covers.  Like the real thing, the plan must only do each
+    # output once, though it can be reached both as an m3u referent and in
+    # the main pass.
+    plan = []
+    planned = set()
+
+    def plan_action(action, rel_path, src=None, src_stat=None):
+        if rel_path in planned:
+            return
+        planned.add(rel_path)
+        entry = {'action': action, 'path': rel_path}
+        if src:
+            entry['source'] = src
+        if action == 'transcode':
+            entry['bytes'] = src_stat.st_size
+            try:
+                entry['seconds'] = audiofile.duration(src)
+            except Exception:
+                logging.warning("Can't tell how long %s is" % src)
+                entry['seconds'] = None
+        plan.append(entry)
+
+    def print_plan():
+        totals = {'bytes': 0, 'seconds': 0.0}
+        for entry in plan:
+            action = entry['action']
+            totals[action] = totals.get(action, 0) + 1
+            if action == 'transcode':
+                totals['bytes'] += entry['bytes']
+                totals['seconds'] += entry['seconds'] or 0
+
+        if args.plan == 'json':
+            print(json.dumps({'actions': plan, 'totals': totals}, indent=2))
+            return
+
+        for entry in plan:
+            print('%-9s  %s' % (entry['action'], entry['path']))
+        print('Would transcode %d files (%.1f MB, %s of audio), '
+              'retag %d, link %d, munge %d playlists, create %d playlists '
+              'and prune %d.'
+              % (totals.get('transcode', 0), totals['bytes'] / 1e6,
+                 audiofile.format_duration(totals['seconds']),
+                 totals.get('retag', 0), totals.get('link', 0),
+                 totals.get('munge', 0), totals.get('playlist', 0),
+                 totals.get('prune', 0)))
+
+    # Removals can go to the I/O pool when nothing is about to take the
+    # removed entry's place.
+
+    def remove_spurious_file(path, background=False):
+        rel_path = os.path.relpath(path, args.cache)
+        if args.plan:
+            plan_action('prune', rel_path)
+            return
+        cache_changed(*os.path.split(rel_path))
+
+        def remove():
+            logging.info('Removing spurious file %s' % path)
+            store_dirty.set()
+            os.unlink(path)
+            run_metrics.action('prune')
+            if cache_manifest:
+                cache_manifest.forget(rel_path)
+
+        if background:
+            runner.io(path, remove, stage='prune')
+        else:
+            remove()
+
+    # Cache directories that we've pruned (or, for a plan, would have), so
+    # that we don't go on to prune what was inside them.
+    pruned_dirs = set()
+
+    def under_pruned(rel_dir):
+        while rel_dir:
+            if rel_dir in pruned_dirs:
+                return True
+            rel_dir = os.path.dirname(rel_dir)
+        return False
 
-    def nuke_non_file(path):
-        if not os.path.exists(path):
+    def remove_spurious_dir(path, background=False):
+        rel_path = os.path.relpath(path, args.cache)
+        pruned_dirs.add(rel_path)
+        if args.plan:
+            plan_action('prune', rel_path)
             return
-        if os.path.islink(path):
-            remove_spurious_file(path)
-        elif os.path.isdir(path):
-            remove_spurious_dir(path)
-        elif not os.path.isfile(path):
-            remove_spurious_file(path)
+        cache_changed(*os.path.split(rel_path))
+        made_dirs.clear()
+
+        def remove():
+            logging.info('Removing spurious directory %s' % path)
+            store_dirty.set()
+            shutil.rmtree(path)
+            run_metrics.action('prune')
+            if cache_manifest:
+                cache_manifest.forget_tree(rel_path)
+
+        if background:
+            runner.io(path, remove, stage='prune')
+        else:
+            remove()
+
+    def nuke_non_file(rel_dir, filename):
+        kind = cache_kind(rel_dir, filename)
+        if kind == 'dir':
+            remove_spurious_dir(cache_path(rel_dir, filename))
+        elif kind is not None and kind != 'file':
+            remove_spurious_file(cache_path(rel_dir, filename))
+
+    # Opened once we're ready to go.  None if we're running without one.
+    cache_manifest = None
+
+    def check_manifest(rel_dir, out_filename, src_stat, settings):
+        """Returns True if the manifest says that a cache entry was built from
+        this exact source with these settings and is still there, False if it
+        was built from something else, or None if we'll have to work it out for
+        ourselves."""
+        if not cache_manifest:
+            return None
+        fresh = cache_manifest.check(os.path.join(rel_dir, out_filename),
+                                     src_stat, settings)
+        if fresh:
+            return cache_kind(rel_dir, out_filename) == 'file'
+        return fresh
+
+    def record_manifest(rel_dir, out_filename, src, src_stat, settings,
+                        signed=False):
+        """`signed` says that the entry is made from the contents of src,
+        so that with --signatures its signature is worth recording."""
+        if cache_manifest and not args.plan:
+            signature = None
+            if signed and args.signatures:
+                contents = source_signature(src, src_stat)
+                if contents:
+                    signature = (contents[0], store.tags_key(contents[1]))
+            cache_manifest.record(os.path.join(rel_dir, out_filename), src,
+                                  src_stat, settings, signature)
+
+    # The audio fingerprints and tags of the sources that we've read in this
+    # sync, by path and stat.
+    source_signatures = {}
+
+    def source_signature(in_path, in_stat):
+        """Returns the audio fingerprint of a source and its tags, or None if
+        we can't fingerprint it.  A playlist's fingerprint is its text."""
+        key = (in_path, in_stat.st_size, in_stat.st_mtime_ns, in_stat.st_ino)
+        if key not in source_signatures:
+            with run_metrics.stage('fingerprint'):
+                if extension(in_path) == '.m3u':
+                    with open(in_path, 'rb') as f:
+                        signature = (hashlib.sha1(f.read()).hexdigest(), [])
+                else:
+                    fingerprint = audiofile.audio_fingerprint(in_path)
+                    signature = fingerprint and (
+                            fingerprint, audiofile.comments(in_path))
+            source_signatures[key] = signature
+        return source_signatures[key]
+
+    def signature_change(in_path, rel_dir, out_filename, in_stat, settings):
+        """For a source whose stat doesn't match its cache entry's any more,
+        returns 'none' if its audio and tags are as they were, 'tags' if only
+        its tags have changed, or None if the entry has to be built again."""
+        if (not args.signatures
+                or cache_kind(rel_dir, out_filename) != 'file'):
+            return None
+        recorded = cache_manifest.signature(
+                os.path.join(rel_dir, out_filename), settings)
+        if recorded is None:
+            return None
+        contents = source_signature(in_path, in_stat)
+        if not contents or contents[0] != recorded[0]:
+            return None
+        if store.tags_key(contents[1]) == recorded[1]:
+            return 'none'
+        return 'tags'
+
+    def partial_path(out_path):
+        """Where we write an output until it's complete, so that a crash can't
+        leave a truncated file behind that looks up to date.  Pruning sweeps
+        up any that a crash does leave."""
+        (dirname, filename) = os.path.split(out_path)
+        return os.path.join(dirname, '.%s.partial' % filename)
+
+    def finish_output(out_path):
+        """Put a complete output in place of whatever was there before."""
+        part_path = partial_path(out_path)
+        with open(part_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(part_path, out_path)
+
+    def remove_partial(out_path):
+        part_path = partial_path(out_path)
+        if os.path.lexists(part_path):
+            logging.warning('Removing %s' % part_path)
+            os.unlink(part_path)
 
     def transcoded_filename(filename):
         if extension(filename) in transcode_formats:
@@ -107,33 +1114,61 @@ def transcode():
     def munge_m3u(music_path, rel_dir, filename):
         src = os.path.join(music_path, rel_dir, filename)
         dst = cache_path(rel_dir, filename)
+        src_stat = source_stat(src)
+        settings = 'munge %s' % output_format
 
-        nuke_non_file(dst)
-        if (os.path.isfile(dst)
-                and os.stat(dst).st_mtime >= os.stat(src).st_mtime):
+        fresh = check_manifest(rel_dir, filename, src_stat, settings)
+        if fresh:
+            logging.info('Not re-munging %s' % dst)
+            run_metrics.action('unchanged')
+            return
+        if (fresh is False and signature_change(src, rel_dir, filename,
+                                                src_stat, settings) == 'none'):
+            logging.info('Not re-munging %s, which is only touched' % dst)
+            run_metrics.action('unchanged')
+            record_manifest(rel_dir, filename, src, src_stat, settings, True)
+            return
+        nuke_non_file(rel_dir, filename)
+        if (fresh is None and cache_kind(rel_dir, filename) == 'file'
+                and cache_stat(rel_dir, filename).st_mtime
+                >= src_stat.st_mtime):
             logging.info('Not re-munging %s' % dst)
+            run_metrics.action('unchanged')
+            record_manifest(rel_dir, filename, src, src_stat, settings, True)
             return
 
         logging.info('Munging playlist %s in %s' % (filename, rel_dir))
-        with open(src, 'r') as f:
-            lines = [x.rstrip() for x in f.readlines()]
+        lines = read_playlist(src)
 
         if any(extension(line) in transcode_formats for line in
                lines):
+            if args.plan:
+                plan_action('munge', os.path.join(rel_dir, filename), src)
+                return
             ensure_dir(cache_path(rel_dir))
-            with open(dst, 'w') as out_f:
-                for line in lines:
-                    if extension(line) in transcode_formats:
-                        logging.info(
-                            '   Munging %s' % (transcoded_filename(line)))
-                        out_f.write('%s\n' % (transcoded_filename(line)))
-                    else:
-                        logging.info('   Passing through %s' % line)
-                        out_f.write('%s\n' % line)
+            cache_changed(rel_dir, filename)
+
+            def write():
+                with open(partial_path(dst), 'w') as out_f:
+                    for line in lines:
+                        if extension(line) in transcode_formats:
+                            logging.info(
+                                '   Munging %s' % (transcoded_filename(line)))
+                            out_f.write('%s\n' % (transcoded_filename(line)))
+                        else:
+                            logging.info('   Passing through %s' % line)
+                            out_f.write('%s\n' % line)
+                finish_output(dst)
+                run_metrics.action('munge',
+                                   bytes_written=os.path.getsize(dst))
+                record_manifest(rel_dir, filename, src, src_stat, settings,
+                                True)
+
+            runner.io(dst, write, stage='playlist')
         else:
-            create_link(music_path, rel_dir, filename)
+            create_link(music_path, rel_dir, filename, settings)
 
-    def create_m3u(music_path, rel_dir, files):
+    def create_m3u(music_paths, rel_dir, files):
         """Creates or updates a playlist, and returns its basename."""
         music_files = [x for x in files if
                        extension(x) in music_formats]
@@ -143,91 +1178,88 @@ def transcode():
         m3u_filename = '%s %s.m3u' % (zeroes(len(music_files)),
                                       os.path.basename(rel_dir))
 
-        src_dir = os.path.join(music_path, rel_dir)
         m3u_path = cache_path(rel_dir, m3u_filename)
 
-        nuke_non_file(m3u_path)
-        if (not args.force_playlists and os.path.isfile(m3u_path)
-                and os.stat(m3u_path).st_mtime >= os.stat(src_dir).st_mtime):
+        # When bases are merged, the playlist is as new as the newest of the
+        # directories that it draws on.
+        (src_stat, src_dir) = max(
+                ((os.stat(os.path.join(m, rel_dir)), os.path.join(m, rel_dir))
+                 for m in music_paths),
+                key=lambda s: s[0].st_mtime_ns)
+        settings = 'playlist %s' % output_format
+
+        fresh = None
+        if not args.force_playlists:
+            fresh = check_manifest(rel_dir, m3u_filename, src_stat, settings)
+            if fresh:
+                logging.info('Not recreating %s' % m3u_path)
+                run_metrics.action('unchanged')
+                return m3u_filename
+        nuke_non_file(rel_dir, m3u_filename)
+        if (not args.force_playlists and fresh is None
+                and cache_kind(rel_dir, m3u_filename) == 'file'
+                and cache_stat(rel_dir, m3u_filename).st_mtime
+                >= src_stat.st_mtime):
             logging.info('Not recreating %s' % m3u_path)
+            run_metrics.action('unchanged')
+            record_manifest(rel_dir, m3u_filename, src_dir, src_stat,
+                            settings)
             return m3u_filename
 
         logging.info('Creating playlist %s in %s' % (m3u_filename, rel_dir))
+        if args.plan:
+            plan_action('playlist', os.path.join(rel_dir, m3u_filename))
+            return m3u_filename
         ensure_dir(cache_path(rel_dir))
-        with open(m3u_path, 'w') as out_f:
-            music_files.sort()
-            for music_file in music_files:
-                if extension(music_file) in transcode_formats:
-                    music_file = transcoded_filename(music_file)
-                logging.info('   Adding %s' % music_file)
-                out_f.write('%s\n' % music_file)
+        cache_changed(rel_dir, m3u_filename)
+
+        def write():
+            with open(partial_path(m3u_path), 'w') as out_f:
+                music_files.sort()
+                for music_file in music_files:
+                    if extension(music_file) in transcode_formats:
+                        music_file = transcoded_filename(music_file)
+                    logging.info('   Adding %s' % music_file)
+                    out_f.write('%s\n' % music_file)
+            finish_output(m3u_path)
+            run_metrics.action('playlist',
+                               bytes_written=os.path.getsize(m3u_path))
+            record_manifest(rel_dir, m3u_filename, src_dir, src_stat,
+                            settings)
+
+        runner.io(m3u_path, write, stage='playlist')
         return m3u_filename
 
-    ogg_header_re = re.compile(b'.+: Ogg data, Vorbis audio, (mono|stereo), ' +
-                               b'(11025|22050|37800|44100|48000)')
-    flac_meta_re = re.compile(b'(GENRE|ARTIST|ALBUM|TITLE|TRACKNUMBER)=(.*)')
-    ogg_meta_re = re.compile(b'(genre|artist|album|title|tracknumber)=(.*)')
     sane_channels = [b'1', b'2']
     sane_frequences = [b'44100', b'48000', b'88200', b'96000', b'192000']
+    sane_ogg_frequences = [b'11025', b'22050', b'37800', b'44100', b'48000']
     sane_bitwidths = [b'16', b'24']
 
     def flac_header(path):
-        [channels, frequency, bitwidth] = subprocess.check_output(
-                [args.metaflac_bin, '--show-channels', '--show-sample-rate',
-                 '--show-bps', path]).rstrip().split(b'\n')
+        with run_metrics.stage('probe'):
+            header_fields = audiofile.flac_header(path)
 
-        if channels not in sane_channels:
+        if header_fields['channels'] not in sane_channels:
             assert False, "Can't parse flac channel magic"
 
-        if frequency not in sane_frequences:
+        if header_fields['frequency'] not in sane_frequences:
             assert False, "Can't parse flac frequency magic"
 
-        if bitwidth not in sane_bitwidths:
+        if header_fields['bitwidth'] not in sane_bitwidths:
             assert False, "Can't parse flac bitwidth magic"
 
-        header_fields = {
-            'channels': channels, 'frequency': frequency, 'bitwidth': bitwidth
-        }
-
-        meta = subprocess.check_output([args.metaflac_bin,
-                                        '--show-tag=GENRE',
-                                        '--show-tag=ARTIST',
-                                        '--show-tag=ALBUM',
-                                        '--show-tag=TITLE',
-                                        '--show-tag=TRACKNUMBER',
-                                        path])
-        for (key, val) in flac_meta_re.findall(meta):
-            header_fields[key.lower()] = val
-
         return header_fields
 
     def ogg_header(path):
-        magic = subprocess.check_output(
-                [args.file_bin, path]).rstrip()
-        m = ogg_header_re.match(magic)
-
-        if m.group(1) == b'mono':
-            channels = b'1'
-        elif m.group(1) == b'stereo':
-            channels = b'2'
-        else:
-            assert False, "Can't parse ogg channel magic"
+        with run_metrics.stage('probe'):
+            header_fields = audiofile.ogg_header(path)
 
-        header_fields = {
-            'channels': channels, 'frequency': m.group(2),
-            'bitwidth': b'16'
-        }
+        if header_fields['channels'] not in sane_channels:
+            assert False, "Can't parse ogg channel magic"
 
-        try:
-            meta = subprocess.check_output([args.ogginfo_bin, path])
-        except subprocess.CalledProcessError as cpe:
-            # ogginfo returns 1 for a truncated-yet-usable vorbis file.
-            if cpe.returncode != 1:
-                raise
-            meta = cpe.output
+        if header_fields['frequency'] not in sane_ogg_frequences:
+            assert False, "Can't parse ogg frequency magic"
 
-        for (key, val) in ogg_meta_re.findall(meta):
-            header_fields[key] = val
         return header_fields
 
     ogg_flags = {
@@ -253,339 +1285,859 @@ def transcode():
                 flags += [flag_set[key], val]
         return flags
 
-    def pipe_transcode(music_path, rel_dir, filename, in_format):
-        ensure_dir(cache_path(rel_dir))
-        in_path = os.path.join(music_path, rel_dir, filename)
-        out_path = cache_path(rel_dir, transcoded_filename(filename))
+    def comment_flags(in_path):
+        """oggenc flags for every comment of a source, which is what oggenc
+        copies when it reads the source itself."""
+        flags = []
+        for (key, val) in audiofile.comments(in_path):
+            flags += ['-c', key.upper() + b'=' + val]
+        return flags
 
-        nuke_non_file(out_path)
-        if (os.path.isfile(out_path)
-                and os.stat(out_path).st_mtime >= os.stat(in_path).st_mtime):
+    def ogg_quality(default):
+        if args.ogg_quality is None:
+            return default
+        return args.ogg_quality
+
+    def note_transcode(rel_dir, out_filename, start, cpu, bytes_read):
+        out_size = os.path.getsize(cache_path(rel_dir, out_filename))
+        run_metrics.action('transcode', bytes_read=bytes_read,
+                           bytes_written=out_size)
+        run_metrics.file(path=os.path.join(args.cache, rel_dir, out_filename),
+                         seconds=time.perf_counter() - start,
+                         cpu_seconds=cpu, bytes_read=bytes_read,
+                         bytes_written=out_size)
+
+    def needs_transcode(in_path, rel_dir, out_filename, in_stat, settings):
+        """Decide whether a cache entry has to be built from in_path, clearing
+        anything that's in its way if so."""
+        out_path = cache_path(rel_dir, out_filename)
+        fresh = check_manifest(rel_dir, out_filename, in_stat, settings)
+        if fresh:
+            logging.info('Not re-transcoding %s' % out_path)
+            run_metrics.action('unchanged')
+            return False
+        change = fresh is False and signature_change(
+                in_path, rel_dir, out_filename, in_stat, settings)
+        if change == 'none':
+            logging.info('Not re-transcoding %s, which is only touched'
+                         % out_path)
+            run_metrics.action('unchanged')
+            record_manifest(rel_dir, out_filename, in_path, in_stat, settings,
+                            True)
+            return False
+        if change == 'tags':
+            retag_output(in_path, rel_dir, out_filename, in_stat, settings)
+            return False
+        ensure_dir(cache_path(rel_dir))
+        nuke_non_file(rel_dir, out_filename)
+        if (fresh is None and cache_kind(rel_dir, out_filename) == 'file'
+                and cache_stat(rel_dir, out_filename).st_mtime
+                >= in_stat.st_mtime):
             logging.info('Not re-transcoding %s' % out_path)
+            run_metrics.action('unchanged')
+            record_manifest(rel_dir, out_filename, in_path, in_stat, settings,
+                            True)
+            return False
+        if args.plan:
+            plan_action('transcode', os.path.join(rel_dir, out_filename),
+                        in_path, in_stat)
+            return False
+        if cache_kind(rel_dir, out_filename) == 'file':
+            store_dirty.set()
+        cache_changed(rel_dir, out_filename)
+        return True
+
+    def retag_output(in_path, rel_dir, out_filename, in_stat, settings):
+        """Give a cache entry its source's new tags, keeping its audio."""
+        out_path = cache_path(rel_dir, out_filename)
+        if args.plan:
+            plan_action('retag', os.path.join(rel_dir, out_filename), in_path)
             return
+        cache_changed(rel_dir, out_filename)
+        (fingerprint, tags) = source_signature(in_path, in_stat)
 
-        print('Transcoding %s' % (os.path.join(rel_dir, filename)))
-        sys.stdout.flush()
+        def retag():
+            logging.info('Retagging %s' % out_path)
+            try:
+                tagging.retag(out_path, partial_path(out_path), tags)
+                finish_output(out_path)
+            except (Exception, KeyboardInterrupt):
+                remove_partial(out_path)
+                raise
+            run_metrics.action('retag',
+                               bytes_written=os.path.getsize(out_path))
+            record_manifest(rel_dir, out_filename, in_path, in_stat, settings,
+                            True)
+            if cache_store:
+                # The old entry may have been the last link to its tags.
+                store_dirty.set()
+                cache_store.add(out_path,
+                                store.audio_key(fingerprint, settings),
+                                store.tags_key(tags))
+
+        runner.io(out_path, retag)
+
+    # The transcoders decide there and then whether a file needs transcoding.
+    # If it does, they return the Source to read and the Target to make from
+    # it, so that the runner can schedule it, along with what other caches
+    # want from the same source.
+
+    def source(in_path, rel_dir, filename, in_format):
+        label = os.path.join(rel_dir, filename)
+        size = source_stat(in_path).st_size
+        if in_format == 'flac':
+            return Source(in_path, label, size, 'flac',
+                          [args.flac_bin, '-d', '-c', '--force-raw-format',
+                           '--endian=little', '--sign=signed', in_path],
+                          lambda: flac_header(in_path))
+        elif in_format == 'ogg':
+            return Source(in_path, label, size, 'oggdec',
+                          [args.oggdec_bin, '-Q', '-R', '-b', '16', '-o', '-',
+                           in_path],
+                          lambda: ogg_header(in_path))
+        else:
+            return Source(in_path, label, size)
+
+    def target(in_path, rel_dir, out_filename, in_stat, settings, tool,
+               raw_cmd, file_cmd, keys=None):
+        """`keys`, if given, are where to file the output in the store."""
+        out_path = cache_path(rel_dir, out_filename)
+
+        def done(start, cpu, bytes_read):
+            finish_output(out_path)
+            record_manifest(rel_dir, out_filename, in_path, in_stat, settings,
+                            True)
+            note_transcode(rel_dir, out_filename, start, cpu, bytes_read)
+            if keys:
+                (akey, tkey, _) = keys
+                cache_store.add(out_path, akey, tkey)
+                for place in store_waiting.pop(akey, []):
+                    place()
+
+        def failed():
+            remove_partial(out_path)
+            if keys:
+                store_waiting.pop(keys[0], None)
+
+        return Target(out_path, tool, raw_cmd, file_cmd, done, failed)
+
+    # In --dedupe mode, the store of transcodes in this cache.
+    cache_store = None
+    # Set once we've removed or replaced something in the cache, which may
+    # leave entries in the store that nothing links to.
+    store_dirty = threading.Event()
+    # Entries to be made from transcodes that this run is doing anyway, by
+    # the audio key of the transcode, and the cache paths that they'll fill.
+    store_waiting = {}
+    store_placing = set()
+
+    def store_keys(in_path, in_stat, settings):
+        """Returns the audio key and tags key that a transcode of in_path
+        would be filed under in the store, and the tags, or None if we can't
+        fingerprint its audio."""
+        contents = source_signature(in_path, in_stat)
+        if not contents:
+            return None
+        (fingerprint, tags) = contents
+        return (store.audio_key(fingerprint, settings), store.tags_key(tags),
+                tags)
+
+    def from_store(in_path, rel_dir, out_filename, in_stat, settings):
+        """Arrange to make a cache entry out of the store, if the same audio
+        has been transcoded with the same settings before, or out of a
+        transcode that's already scheduled.  Returns True if that's taken care
+        of it, or else the keys to file the transcode under, if any."""
+        keys = store_keys(in_path, in_stat, settings)
+        if keys is None:
+            return None
+        (akey, tkey, tags) = keys
+        out_path = cache_path(rel_dir, out_filename)
+
+        def place():
+            place_from_store(akey, tkey, tags, in_path, rel_dir, out_filename,
+                             in_stat, settings)
+
+        if akey in store_waiting:
+            store_waiting[akey].append(place)
+            store_placing.add(out_path)
+            return True
+        if cache_store.any_path(akey):
+            runner.io(out_path, place)
+            return True
+        store_waiting[akey] = []
+        return keys
+
+    def place_from_store(akey, tkey, tags, in_path, rel_dir, out_filename,
+                         in_stat, settings):
+        """Link a cache entry to the store entry with the same audio and
+        tags, or, if there's only one with other tags, copy that and retag it,
+        and file the copy."""
+        out_path = cache_path(rel_dir, out_filename)
+        part_path = partial_path(out_path)
+        stored = cache_store.path(akey, tkey)
+        if os.path.lexists(part_path):
+            os.unlink(part_path)
         try:
-            decode_proc = None
-            encode_proc = None
-            with open(os.devnull, 'w') as dev_null:
-                if in_format == 'flac':
-                    header_data = flac_header(in_path)
-                    decode_proc = subprocess.Popen(
-                            [args.flac_bin, '-d', '-c',
-                             '--force-raw-format', '--endian=little',
-                             '--sign=signed', in_path],
-                            stdout=subprocess.PIPE, stderr=dev_null)
-                elif in_format == 'ogg':
-                    header_data = ogg_header(in_path)
-                    decode_proc = subprocess.Popen(
-                            [args.oggdec_bin, '-Q', '-R', '-b', '16',
-                             '-o', '-', in_path],
-                            stdout=subprocess.PIPE, stderr=dev_null)
-                else:
-                    raise Exception(
-                            "We shouldn't be trying to transcode " + in_format)
-
-                logging.debug('%s has channels=%s bitwidth=%s frequency=%s' %
-                              (in_path, header_data['channels'],
-                               header_data['bitwidth'],
-                               header_data['frequency']))
-
-                if args.mp3:
-                    if header_data['channels'] == b'1':
-                        channels = 'm'
-                    elif header_data['channels'] == b'2':
-                        channels = 's'
-                    else:
-                        assert False, ("Can't parse channels %s" %
-                                       header_data['channels'])
-
-                    # TODO(jleen): Make sane_frequences into a map. Or just
-                    # do string twiddling. (No floating point, please.)
-                    if header_data['frequency'] == b'11025':
-                        frequency = '11.025'
-                    elif header_data['frequency'] == b'22050':
-                        frequency = '22.05'
-                    elif header_data['frequency'] == b'37800':
-                        frequency = '37.8'
-                    elif header_data['frequency'] == b'44100':
-                        frequency = '44.1'
-                    elif header_data['frequency'] == b'48000':
-                        frequency = '48'
-                    elif header_data['frequency'] == b'88200':
-                        frequency = '88.2'
-                    elif header_data['frequency'] == b'96000':
-                        frequency = '96'
-                    elif header_data['frequency'] == b'192000':
-                        frequency = '96'
-                    else:
-                        assert False, ("Can't parse frequency %s" %
-                                       frequency_spec)
-
-                    meta_flags = header_to_flags(header_data, mp3_flags)
-                    encode_proc = subprocess.Popen(
-                            [args.lame_bin,
-                             '--quiet',
-                             '--preset', 'medium',
-                             '-r', '--little-endian',
-                             '--bitwidth', header_data['bitwidth'],
-                             '-s', frequency,
-                             '-m', channels] + meta_flags + [
-                                '-', out_path],
-                            stdin=decode_proc.stdout,
-                            stdout=subprocess.PIPE, stderr=dev_null)
-                else:
-                    meta_flags = header_to_flags(header_data, ogg_flags)
-                    encode_proc = subprocess.Popen(
-                            [args.ogg_bin,
-                             '-r',
-                             '-q', str(args.ogg_quality),
-                             '-B', header_data['bitwidth'],
-                             '-C', header_data['channels'],
-                             '-R', header_data['frequency']] + meta_flags + [
-                                '-o', out_path, '-'],
-                            stdin=decode_proc.stdout,
-                            stdout=subprocess.PIPE, stderr=dev_null)
-                decode_proc.stdout.close()
-                encode_proc.communicate()
-                # TODO(jleen): Is poll() exactly what we want? Is there a
-                # race here
-                # if decode_proc sits around after encode_proc terminates?
-                decode_proc.poll()
-            if encode_proc.returncode != 0:
-                if args.mp3:
-                    encoder = 'lame'
-                else:
-                    encoder = 'oggenc'
-                raise Exception('Abnormal %s termination' % encoder)
-            if decode_proc.returncode != 0:
-                raise Exception('Abnormal %s termination' % in_format)
+            if os.path.exists(stored):
+                logging.info('Linking %s from the store' % out_path)
+                os.link(stored, part_path)
+                how = 'dedupe'
+            else:
+                logging.info('Retagging %s from the store' % out_path)
+                tagging.retag(cache_store.any_path(akey), part_path, tags)
+                how = 'retag'
+            finish_output(out_path)
         except (Exception, KeyboardInterrupt):
-            # Remove the (presumably incomplete) output file if we crash during
-            # transcoding.
-            if os.path.isfile(out_path):
-                logging.warning('Removing %s' % out_path)
-                os.unlink(out_path)
+            remove_partial(out_path)
             raise
+        if how == 'retag':
+            cache_store.add(out_path, akey, tkey)
+            run_metrics.action(how, bytes_written=os.path.getsize(out_path))
+        else:
+            run_metrics.action(how)
+        record_manifest(rel_dir, out_filename, in_path, in_stat, settings,
+                        True)
+
+    def collect_store():
+        if cache_store and store_dirty.is_set():
+            store_dirty.clear()
+            with run_metrics.stage('prune'):
+                removed = cache_store.collect()
+            if removed:
+                logging.info('Removed %d entries from the store' % removed)
+
+    def pipe_transcode(music_path, rel_dir, filename, in_format):
+        in_path = os.path.join(music_path, rel_dir, filename)
+        out_filename = transcoded_filename(filename)
+        out_path = cache_path(rel_dir, out_filename)
+        in_stat = source_stat(in_path)
+        if args.mp3:
+            settings = 'lame --preset medium'
+        else:
+            settings = 'oggenc -q %d' % ogg_quality(OGG_LOSSY_QUALITY)
+
+        if not needs_transcode(in_path, rel_dir, out_filename, in_stat,
+                               settings):
+            return None
+        keys = cache_store and from_store(in_path, rel_dir, out_filename,
+                                          in_stat, settings)
+        if keys is True:
+            return None
+
+        if in_format not in ['flac', 'ogg']:
+            raise Exception("We shouldn't be trying to transcode "
+                            + in_format)
+
+        def lame_cmd(header_data):
+            if header_data['channels'] == b'1':
+                channels = 'm'
+            elif header_data['channels'] == b'2':
+                channels = 's'
+            else:
+                assert False, ("Can't parse channels %s" %
+                               header_data['channels'])
+
+            # TODO(jleen): Make sane_frequences into a map. Or just do string
+            # twiddling. (No floating point, please.)
+            if header_data['frequency'] == b'11025':
+                frequency = '11.025'
+            elif header_data['frequency'] == b'22050':
+                frequency = '22.05'
+            elif header_data['frequency'] == b'37800':
+                frequency = '37.8'
+            elif header_data['frequency'] == b'44100':
+                frequency = '44.1'
+            elif header_data['frequency'] == b'48000':
+                frequency = '48'
+            elif header_data['frequency'] == b'88200':
+                frequency = '88.2'
+            elif header_data['frequency'] == b'96000':
+                frequency = '96'
+            elif header_data['frequency'] == b'192000':
+                frequency = '96'
+            else:
+                assert False, ("Can't parse frequency %s" %
+                               header_data['frequency'])
+
+            meta_flags = header_to_flags(header_data, mp3_flags)
+            return ([args.lame_bin,
+                     '--quiet',
+                     '--preset', 'medium',
+                     '-r', '--little-endian',
+                     '--bitwidth', header_data['bitwidth'],
+                     '-s', frequency,
+                     '-m', channels] + meta_flags + [
+                        '-', partial_path(out_path)])
+
+        def oggenc_cmd(header_data):
+            meta_flags = header_to_flags(header_data, ogg_flags)
+            return ([args.ogg_bin,
+                     '-r',
+                     '-q', str(ogg_quality(OGG_LOSSY_QUALITY)),
+                     '-B', header_data['bitwidth'],
+                     '-C', header_data['channels'],
+                     '-R', header_data['frequency']]
+                    + meta_flags
+                    + ['-o', partial_path(out_path), '-'])
+
+        if args.mp3:
+            (encoder, raw_cmd) = ('lame', lame_cmd)
+        else:
+            (encoder, raw_cmd) = ('oggenc', oggenc_cmd)
+        return (source(in_path, rel_dir, filename, in_format),
+                target(in_path, rel_dir, out_filename, in_stat, settings,
+                       encoder, raw_cmd, None, keys))
 
     def transcode_flac(music_path, rel_dir, filename):
         if args.mp3:
-            pipe_transcode(music_path, rel_dir, filename, 'flac')
+            return pipe_transcode(music_path, rel_dir, filename, 'flac')
         else:
-            transcode_wav(music_path, rel_dir, filename)
+            return transcode_wav(music_path, rel_dir, filename)
 
     def transcode_ogg(music_path, rel_dir, filename):
-        pipe_transcode(music_path, rel_dir, filename, 'ogg')
+        return pipe_transcode(music_path, rel_dir, filename, 'ogg')
 
     # TODO(jleen): Refactor this and pipe_transcode.
     def transcode_wav(music_path, rel_dir, filename):
-        ensure_dir(cache_path(rel_dir))
         wav_path = os.path.join(music_path, rel_dir, filename)
+        out_filename = transcoded_filename(filename)
+        out_path = cache_path(rel_dir, out_filename)
+        wav_stat = source_stat(wav_path)
+        quality = ogg_quality(OGG_LOSSLESS_QUALITY)
+        if args.mp3:
+            encoder = 'lame'
+            settings = 'lame --preset standard'
+        else:
+            encoder = 'oggenc'
+            settings = 'oggenc -q %d' % quality
+
+        if not needs_transcode(wav_path, rel_dir, out_filename, wav_stat,
+                               settings):
+            return None
+        keys = cache_store and from_store(wav_path, rel_dir, out_filename,
+                                          wav_stat, settings)
+        if keys is True:
+            return None
+
+        raw_cmd = None
+        if args.mp3:
+            file_cmd = [args.lame_bin, '--quiet', '--preset', 'standard',
+                        wav_path, partial_path(out_path)]
+        else:
+            file_cmd = [args.ogg_bin, wav_path, '-q', str(quality), '-o',
+                        partial_path(out_path)]
+
+            # oggenc reads FLAC itself, but if another cache wants the same
+            # FLAC decoded, it gets the PCM with everybody else, and the
+            # comments that it would have copied.
+            def raw_cmd(header_data):
+                return ([args.ogg_bin, '-r', '-q', str(quality),
+                         '-B', header_data['bitwidth'],
+                         '-C', header_data['channels'],
+                         '-R', header_data['frequency']]
+                        + comment_flags(wav_path)
+                        + ['-o', partial_path(out_path), '-'])
+        in_format = extension(filename).lstrip('.')
+        return (source(wav_path, rel_dir, filename, in_format),
+                target(wav_path, rel_dir, out_filename, wav_stat, settings,
+                       encoder, raw_cmd, file_cmd, keys))
+
+    def schedule(transcoder, music_path, rel_dir, filename):
+        """Queue a transcode, if the file needs one."""
+        # A file can be reached both as an m3u referent and in the main pass,
+        # and we mustn't have two jobs writing the same output at once.
         out_path = cache_path(rel_dir, transcoded_filename(filename))
-
-        nuke_non_file(out_path)
-        if (os.path.isfile(out_path)
-                and os.stat(out_path).st_mtime >= os.stat(wav_path).st_mtime):
-            logging.info('Not re-transcoding %s' % out_path)
+        if runner.is_pending(out_path) or out_path in store_placing:
             return
+        job = transcoder(music_path, rel_dir, filename)
+        if job is not None:
+            runner.schedule(*job)
 
-        print('Transcoding %s' % (os.path.join(rel_dir, filename)))
-        sys.stdout.flush()
-        try:
-            with open(os.devnull, 'w') as dev_null:
-                if args.mp3:
-                    encode_proc = subprocess.Popen(
-                            [args.lame_bin, '--quiet', '--preset',
-                             'standard',
-                             wav_path, out_path],
-                            stdout=subprocess.PIPE, stderr=dev_null)
-                else:
-                    encode_proc = subprocess.Popen(
-                            [args.ogg_bin, wav_path, '-q', '6', '-o',
-                             out_path],
-                            stdout=subprocess.PIPE, stderr=dev_null)
-                encode_proc.communicate()
-            if encode_proc.returncode != 0:
-                raise Exception('Abnormal oggenc termination')
-        except (Exception, KeyboardInterrupt):
-            # Remove the (presumably incomplete) Vorbis if we crash during
-            # transcoding.
-            if os.path.exists(out_path):
-                logging.debug('Removing %s' % out_path)
-                os.unlink(out_path)
-            raise
-
-    def create_link(music_path, rel_dir, filename):
-        ensure_dir(cache_path(rel_dir))
+    def create_link(music_path, rel_dir, filename, settings='link',
+                    background=True):
         src = os.path.join(music_path, rel_dir, filename)
         dst = cache_path(rel_dir, filename)
+        if runner.is_pending(dst):
+            return
+        src_stat = source_stat(src)
 
-        nuke_non_file(dst)
-        if os.path.isfile(dst):
-            # Nothin' to do if src and dst are already hard link buddies.
-            if os.stat(src).st_ino == os.stat(dst).st_ino:
+        if check_manifest(rel_dir, filename, src_stat, settings):
+            logging.info('Not re-linking %s' % dst)
+            run_metrics.action('unchanged')
+            return
+        ensure_dir(cache_path(rel_dir))
+        nuke_non_file(rel_dir, filename)
+        if cache_kind(rel_dir, filename) == 'file':
+            # Nothin' to do if src and dst are already hard link buddies, or
+            # if dst is a copy of this very version of src.
+            dst_stat = cache_stat(rel_dir, filename)
+            if ((dst_stat.st_dev, dst_stat.st_ino)
+                    == (src_stat.st_dev, src_stat.st_ino)
+                    or (dst_stat.st_size, dst_stat.st_mtime_ns)
+                    == (src_stat.st_size, src_stat.st_mtime_ns)):
                 logging.info('Not re-linking %s' % dst)
+                run_metrics.action('unchanged')
+                record_manifest(rel_dir, filename, src, src_stat, settings)
                 return
-            else:
-                os.unlink(dst)
+            stale = True
+        else:
+            stale = False
 
         logging.info('Linking %s in %s' % (filename, rel_dir))
-        os.link(src, dst)
-
-    # TODO(jleen): With a bit of work, this could be done in the main loop
-    # as part
-    # of a single traversal that both pre- and post-visits each directory.
-    def contains_sigil(path):
-        """Walk the tree from the given directory and return whether it or a
-        descendant contains a sigil file."""
-        for path, dirs, files in os.walk(path):
-            if args.sigil in files:
-                return True
-        return False
+        if args.plan:
+            plan_action('link', os.path.join(rel_dir, filename), src)
+            return
+        cache_changed(rel_dir, filename)
+
+        def link():
+            if stale:
+                os.unlink(dst)
+            how = link_or_copy(src, dst, src_stat)
+            if how == 'link':
+                run_metrics.action('link')
+            else:
+                run_metrics.action(how, bytes_read=src_stat.st_size,
+                                   bytes_written=src_stat.st_size)
+            record_manifest(rel_dir, filename, src, src_stat, settings)
+
+        if background:
+            runner.io(dst, link, stage='link')
+        else:
+            link()
+
+    # Source devices that we've found we can't hard link into the cache from.
+    copy_devices = set()
+
+    def link_or_copy(src, dst, src_stat):
+        """Hard link a source file into the cache, or, if it's on another
+        filesystem, copy it, keeping its mtime so that the copy looks up to
+        date next time.  Returns 'link' or the kind of copy."""
+        if src_stat.st_dev not in copy_devices:
+            try:
+                os.link(src, dst)
+                return 'link'
+            except OSError as e:
+                # EPERM is what filesystems without hard links say.
+                if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                    raise
+                logging.info("Can't link %s (%s); copying" % (src,
+                                                               e.strerror))
+                if e.errno == errno.EXDEV:
+                    copy_devices.add(src_stat.st_dev)
+        part_path = partial_path(dst)
+        try:
+            how = clone_file(src, part_path)
+            os.chmod(part_path, stat.S_IMODE(src_stat.st_mode))
+            os.utime(part_path, ns=(src_stat.st_atime_ns,
+                                    src_stat.st_mtime_ns))
+            os.replace(part_path, dst)
+        except (Exception, KeyboardInterrupt):
+            remove_partial(dst)
+            raise
+        return how
+
+    # Relative paths of the directories that contain a sigil file, either
+    # directly or in a descendant.  walk_path_with_sigil fills this in as it
+    # goes, so it's complete once any walk has run to the end.
+    sigil_dirs = set()
+
+    def note_sigil(rel_dir):
+        while rel_dir not in sigil_dirs:
+            sigil_dirs.add(rel_dir)
+            rel_dir = os.path.dirname(rel_dir)
+
+    def contains_sigil(rel_dir, leaf_dir):
+        """Return whether the given directory or a descendant contains a sigil
+        file.  Only valid after a complete walk."""
+        if not args.sigil_index:
+            return any(walk_for_sigil(os.path.join(m, rel_dir, leaf_dir),
+                                      args.sigil)
+                       for m in args.music)
+        return os.path.join(rel_dir, leaf_dir) in sigil_dirs
 
     # Takes a list of base directories and walks them as a single merged
-    # hierarchy.
+    # hierarchy, in sorted order, listing each directory of each base once.
+    # If more than one base has an entry with the same relative path, the base
+    # listed first wins, except that directories of the same name are merged.
+    # For each directory we yield a dict saying which base each file comes
+    # from.
     def walk_path_with_sigil(bases):
-        [base_path] = bases
-        sigil_path = None
-        for path, dirs, files in os.walk(base_path):
-            assert path.startswith(base_path)
-            rel_dir = path[1 + len(base_path):]
-
-            # If we're in sigil mode, see if we're crossing a sigil boundary.
-            # TODO(jleen): This is going to be fun in merge mode.
-            if args.sigil:
-                if sigil_path and not path.startswith(sigil_path):
-                    sigil_path = None
-                if not sigil_path and args.sigil in files:
-                    sigil_path = path
-
-            # Trim silly directories.
-            if args.skip_dir:
-                for dirname in args.skip_dir:
-                    if dirname in dirs:
-                        dirs.remove(dirname)
-
-            in_sigil = sigil_path or not args.sigil
-            yield base_path, rel_dir, dirs, files, in_sigil
+        return walk_merged_dir(bases, '', False)
+
+    # In --watch mode, the inotify watcher.  Every directory that we walk gets
+    # watched.
+    watcher = None
+
+    def walk_merged_dir(bases, rel_dir, parent_in_sigil):
+        start = time.perf_counter()
+        sources = {}
+        entries = {}
+        subdir_bases = {}
+        for base_path in bases:
+            if watcher:
+                watcher.watch(os.path.join(base_path, rel_dir), rel_dir)
+            with os.scandir(os.path.join(base_path, rel_dir)) as it:
+                for entry in it:
+                    name = entry.name
+                    if name in sources:
+                        continue
+                    if entry.is_dir():
+                        if name in subdir_bases:
+                            subdir_bases[name].append(base_path)
+                        else:
+                            # Like os.walk, list symlinked directories but
+                            # don't descend into them.
+                            subdir_bases[name] = (
+                                    [] if entry.is_symlink() else [base_path])
+                    elif name not in subdir_bases:
+                        sources[name] = base_path
+                        entries[os.path.join(base_path, rel_dir, name)] = entry
+        files = sorted(sources)
+        dirs = sorted(subdir_bases)
+        run_metrics.add_time('walk', time.perf_counter() - start)
+
+        # If we're in sigil mode, see if we're crossing a sigil boundary.
+        in_sigil = not args.sigil or parent_in_sigil
+        if args.sigil and args.sigil in sources:
+            in_sigil = True
+            note_sigil(rel_dir)
+
+        # Trim silly directories.
+        if args.skip_dir:
+            for dirname in args.skip_dir:
+                if dirname in dirs:
+                    dirs.remove(dirname)
+
+        source_entries.clear()
+        source_entries.update(entries)
+        yield sources, rel_dir, dirs, files, in_sigil
+
+        for d in dirs:
+            if subdir_bases.get(d):
+                yield from walk_merged_dir(subdir_bases[d],
+                                           os.path.join(rel_dir, d), in_sigil)
+
+    def find_base(rel_path, default):
+        """Returns the base that a path in the merged hierarchy comes from."""
+        for base_path in args.music:
+            if os.path.lexists(os.path.join(base_path, rel_path)):
+                return base_path
+        return default
+
+    # The lines of the playlists that we've read during this walk, by source
+    # path, so that finding referents and munging each read it only once.
+    playlists = {}
+
+    def read_playlist(m3u):
+        lines = playlists.get(m3u)
+        if lines is None:
+            with open(m3u, 'r') as f:
+                try:
+                    lines = [x.rstrip() for x in f.readlines()]
+                except:
+                    print('Error reading ' + m3u, file=sys.stderr)
+                    raise
+            playlists[m3u] = lines
+        return lines
 
     def find_referents(music_path, rel_dir, m3u_filename):
         m3u = os.path.join(music_path, rel_dir, m3u_filename)
         referents = []
+        lines = read_playlist(m3u)
 
-        with open(m3u, 'r') as f:
-            try:
-                lines = [x.rstrip() for x in f.readlines()]
-            except:
-                print('Error reading ' + m3u, file=sys.stderr)
-                raise
-
-        # TODO(jleen): Unify this with the eerily similar loop in update_cache.
+        # TODO(jleen): Unify this with the eerily similar loop in build_dir.
         for line in lines:
             if line.startswith(".."):
                 ref = os.path.normpath(os.path.join(rel_dir, line))
                 assert (not ref.startswith(".."))
                 logging.info('Handling referent %s of %s' % (ref, m3u))
                 (ref_dir, ref_filename) = os.path.split(ref)
+                ref_base = find_base(ref, music_path)
 
                 # TODO(jleen): Refactor.
                 ext = extension(ref_filename)
                 if ext in transcode_formats:
                     if ext == '.flac':
-                        transcode_flac(music_path, ref_dir, ref_filename)
+                        schedule(transcode_flac,
+                                 ref_base, ref_dir, ref_filename)
                         referents += [os.path.join(
                                 ref_dir, transcoded_filename(ref_filename))]
                     if ext == '.ogg':
-                        transcode_ogg(music_path, ref_dir, ref_filename)
+                        schedule(transcode_ogg,
+                                 ref_base, ref_dir, ref_filename)
                         referents += [os.path.join(
                                 ref_dir, transcoded_filename(ref_filename))]
                     if ext == '.wav':
-                        transcode_wav(music_path, ref_dir, ref_filename)
+                        schedule(transcode_wav,
+                                 ref_base, ref_dir, ref_filename)
                         referents += [os.path.join(
                                 ref_dir, transcoded_filename(ref_filename))]
                 if ext in okay_formats:
-                    create_link(music_path, ref_dir, ref_filename)
+                    # The walk may not have listed the referent's directory
+                    # yet, and mustn't see the link half made when it does.
+                    create_link(ref_base, ref_dir, ref_filename,
+                                background=False)
                     referents += [ref]
 
         return referents
 
     def contains_referent(rel_dir, leaf_dir, m3u_referents):
-        path = os.path.join(rel_dir, leaf_dir)
-        return any(ref.startswith(path) for ref in m3u_referents)
+        return m3u_referents.contains_under(os.path.join(rel_dir, leaf_dir))
+
+    # Cache paths of m3u referents, which the main pass must leave alone.
+    m3u_referents = ReferentIndex()
 
     def update_cache():
         """Ensure that everything in the master is reflected in the cache.
         Mostly this is done by creating hard links, but FLAC is transcoded to
         Vorbis."""
 
-        # First, do all m3u referents.  Need to do this in a preliminary pass,
-        # because the main pass will delete any files it doesn't recognize, and
-        # the files we find here could be anywhere in the tree.
-        m3u_referents = set()
-        for music_path, rel_dir, dirs, files, in_sigil in walk_path_with_sigil(
-                args.music):
-            if in_sigil:
-                for filename in files:
-                    if extension(filename) == '.m3u':
-                        m3u_referents.update(
-                                find_referents(music_path, rel_dir, filename))
-
-        for music_path, rel_dir, dirs, files, in_sigil in walk_path_with_sigil(
-                args.music):
-            # Build cache files that are missing or outdated.
-            did_music = False
-            did_playlist = False
-            file_set = set()
-            if in_sigil:
-                files.sort()
-                for filename in files:
-                    ext = extension(filename)
-                    if not filename.startswith('.'):
-                        if ext == '.m3u':
-                            munge_m3u(music_path, rel_dir, filename)
-                            file_set.add(filename)
-                            did_playlist = True
-                        if ext in transcode_formats:
+        # m3u referents could be anywhere in the tree, and so could sigils,
+        # so we can't tell what to prune from any directory until the walk
+        # has seen every playlist and every sigil.  Build everything as we
+        # walk, and prune once we're done, from the listings that we took on
+        # the way.
+        m3u_referents.clear()
+        sigil_dirs.clear()
+        pruned_dirs.clear()
+        try:
+            built = [build_dir(*walked)
+                     for walked in walk_path_with_sigil(args.music)]
+        finally:
+            playlists.clear()
+        runner.io_wait()
+        for b in built:
+            prune_dir(*b)
+
+    def update_dir(sources, rel_dir, dirs, files, in_sigil):
+        """Bring one directory of the cache up to date, not counting its
+        subdirectories, except to prune the ones that shouldn't be there."""
+        try:
+            built = build_dir(sources, rel_dir, dirs, files, in_sigil)
+        finally:
+            playlists.clear()
+        runner.io_wait()
+        prune_dir(*built)
+
+    def build_dir(sources, rel_dir, dirs, files, in_sigil):
+        """Build the files that are missing from one directory of the cache,
+        or out of date, and schedule its transcodes.  Returns the arguments
+        for prune_dir."""
+        cache_listings[rel_dir] = list_cache_dir(rel_dir)
+
+        # Build cache files that are missing or outdated.
+        did_music = False
+        did_playlist = False
+        file_set = set()
+        if in_sigil:
+            files.sort()
+            for filename in files:
+                ext = extension(filename)
+                if ext == '.m3u':
+                    with run_metrics.stage('referents'):
+                        m3u_referents.update(find_referents(
+                                sources[filename], rel_dir, filename))
+                if not filename.startswith('.'):
+                    if ext == '.m3u':
+                        with run_metrics.stage('playlist'):
+                            munge_m3u(sources[filename], rel_dir, filename)
+                        file_set.add(filename)
+                        did_playlist = True
+                    if ext in transcode_formats:
+                        with run_metrics.stage('schedule'):
                             if ext == '.flac':
-                                transcode_flac(music_path, rel_dir, filename)
+                                schedule(transcode_flac,
+                                         sources[filename], rel_dir,
+                                         filename)
                                 file_set.add(transcoded_filename(filename))
                             if ext == '.ogg':
-                                transcode_ogg(music_path, rel_dir, filename)
+                                schedule(transcode_ogg,
+                                         sources[filename], rel_dir,
+                                         filename)
                                 file_set.add(transcoded_filename(filename))
                             if ext == '.wav':
-                                transcode_wav(music_path, rel_dir, filename)
+                                schedule(transcode_wav,
+                                         sources[filename], rel_dir,
+                                         filename)
                                 file_set.add(transcoded_filename(filename))
-                    if ((ext in link_extns and not filename.startswith('.'))
-                            or (args.keep_sigil
-                                and filename in args.keep_sigil)):
-                        create_link(music_path, rel_dir, filename)
-                        file_set.add(filename)
-                    if ext in music_formats:
-                        did_music = True
-                if did_music and not did_playlist:
-                    file_set.add(create_m3u(music_path, rel_dir, files))
-
-            # Remove files and directories from the cache that aren't in the
-            # master.
-            dir_set = frozenset(d for d in dirs if in_sigil
-                                or contains_referent(
-                                        rel_dir, d, m3u_referents)
-                                or any(contains_sigil(
-                                        os.path.join(m, rel_dir, d))
-                                       for m in args.music))
-            if os.path.isdir(cache_path(rel_dir)):
-                for filename in os.listdir(cache_path(rel_dir)):
-                    path = cache_path(rel_dir, filename)
-                    if os.path.isdir(path):
-                        if filename not in dir_set:
-                            if os.path.islink(path):
-                                remove_spurious_file(path)
-                            else:
-                                remove_spurious_dir(path)
-                    elif (filename not in file_set
-                          and os.path.join(rel_dir,
-                                           filename) not in m3u_referents):
-                        remove_spurious_file(path)
-
-    update_cache()
+                if ((ext in link_extns and not filename.startswith('.'))
+                        or (args.keep_sigil
+                            and filename in args.keep_sigil)):
+                    with run_metrics.stage('link'):
+                        create_link(sources[filename], rel_dir, filename)
+                    file_set.add(filename)
+                if ext in music_formats:
+                    did_music = True
+            if did_music and not did_playlist:
+                with run_metrics.stage('playlist'):
+                    file_set.add(create_m3u(set(sources.values()), rel_dir,
+                                            files))
+
+        return rel_dir, dirs, in_sigil, file_set
+
+    def prune_dir(rel_dir, dirs, in_sigil, file_set):
+        """Remove files and directories from a directory of the cache that
+        aren't in the master."""
+        if under_pruned(rel_dir):
+            cache_listings.pop(rel_dir, None)
+            return
+        dir_set = frozenset(d for d in dirs if in_sigil
+                            or contains_referent(
+                                    rel_dir, d, m3u_referents)
+                            or contains_sigil(rel_dir, d))
+        with run_metrics.stage('prune'):
+            listing = cache_listings.pop(rel_dir)
+            if None in listing.values():
+                # We've changed the directory since we listed it.
+                listing = list_cache_dir(rel_dir)
+            for (filename, entry) in listing.items():
+                path = entry.path
+                if entry.is_dir():
+                    if (filename not in dir_set
+                            and not (rel_dir == '' and cache_store
+                                     and store.is_store_dir(filename))):
+                        if entry.is_symlink():
+                            remove_spurious_file(path, background=True)
+                        else:
+                            remove_spurious_dir(path, background=True)
+                elif (filename not in file_set
+                      and not m3u_referents.contains(rel_dir, filename)
+                      and not (rel_dir == ''
+                               and manifest.is_manifest_file(filename))):
+                    remove_spurious_file(path, background=True)
+
+    def music_bases(rel_dir):
+        """The bases that have a real directory at the given path."""
+        return [base_path for base_path in args.music
+                if os.path.isdir(os.path.join(base_path, rel_dir))
+                and not os.path.islink(os.path.join(base_path, rel_dir))]
+
+    def above_in_sigil(rel_dir):
+        """Whether a sigil in some directory above this one puts it inside a
+        sigil."""
+        while rel_dir:
+            rel_dir = os.path.dirname(rel_dir)
+            for base_path in args.music:
+                if os.path.isfile(os.path.join(base_path, rel_dir,
+                                               args.sigil)):
+                    return True
+        return False
+
+    def skipped(rel_dir):
+        return args.skip_dir and any(d in args.skip_dir
+                                     for d in rel_dir.split(os.sep))
+
+    def update_changed(changed, created):
+        """Bring just the given directories of the cache up to date, along
+        with everything under the ones in `created`, which are new to us."""
+        pruned_dirs.clear()
+        for rel_dir in sorted(changed | created):
+            if any(rel_dir.startswith(os.path.join(d, '')) for d in created):
+                # We'll get to it when we walk its new ancestor.
+                continue
+            bases = music_bases(rel_dir)
+            if not bases:
+                # Gone, so its parent will prune it.
+                continue
+            in_sigil = not args.sigil or above_in_sigil(rel_dir)
+            walk = walk_merged_dir(bases, rel_dir, in_sigil)
+            if rel_dir not in created:
+                walk = itertools.islice(walk, 1)
+            for walked in walk:
+                update_dir(*walked)
+
+    def watch_music():
+        """Wait for changes to the music and apply them as they come in, a
+        burst at a time.  The only way out is an interrupt."""
+        while True:
+            events = watcher.read()
+            deadline = time.monotonic() + WATCH_MAX_DELAY
+            while time.monotonic() < deadline:
+                more = watcher.read(WATCH_SETTLE)
+                if not more:
+                    break
+                events += more
+
+            # Each burst is a run of its own, as far as the metrics go.
+            run_metrics.reset()
+            changed = set()
+            created = set()
+            resync = False
+            for (rel_dir, name, mask) in events:
+                if rel_dir is None:
+                    logging.warning('Lost track of changes; resyncing')
+                    resync = True
+                    continue
+                if not name:
+                    # Something happened to the directory itself, which its
+                    # parent will hear about.
+                    continue
+                if skipped(rel_dir):
+                    continue
+                # Playlists and sigils affect what belongs in the cache far
+                # from where they are, and so do referents outside of a
+                # sigil.
+                if (extension(name) == '.m3u' or name == args.sigil
+                        or (args.sigil
+                            and m3u_referents.contains_under(rel_dir))):
+                    resync = True
+                changed.add(rel_dir)
+                arrived = inotify.IN_CREATE | inotify.IN_MOVED_TO
+                if mask & inotify.IN_ISDIR and mask & arrived:
+                    created.add(os.path.join(rel_dir, name))
+
+            try:
+                if resync:
+                    logging.info('Resyncing everything')
+                    update_cache()
+                else:
+                    logging.info('Updating %s' % ', '.join(
+                            sorted(changed | created)))
+                    update_changed(changed, created)
+                runner.run()
+                store_placing.clear()
+                source_signatures.clear()
+                collect_store()
+                ok = True
+            except Exception:
+                logging.exception('Failed to apply changes; continuing')
+                runner.reset()
+                store_waiting.clear()
+                store_placing.clear()
+                source_signatures.clear()
+                ok = False
+            if cache_manifest:
+                cache_manifest.commit()
+            write_metrics(ok)
+
+    try:
+        if args.plan:
+            if args.manifest and manifest.exists(args.cache):
+                cache_manifest = manifest.Manifest(args.cache, readonly=True)
+        elif args.manifest:
+            cache_manifest = manifest.Manifest(args.cache)
+        if args.dedupe and output_format:
+            cache_store = store.Store(args.cache, output_format)
+        if args.watch:
+            from discjockey import inotify
+            # Start watching before the first sync walks the tree, so that we
+            # don't miss anything that changes while it runs.
+            watcher = inotify.Watcher()
+        update_cache()
+        yield
+        store_placing.clear()
+        source_signatures.clear()
+        if args.plan:
+            print_plan()
+        else:
+            collect_store()
+        if watcher:
+            if cache_manifest:
+                cache_manifest.commit()
+            write_metrics(True)
+            watch_music()
+    finally:
+        if cache_manifest:
+            cache_manifest.close()
+        if watcher:
+            watcher.close()